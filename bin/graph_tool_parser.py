@@ -92,15 +92,6 @@ def save_robust(g, stem):
             )  # raw edge values are hashed vertex names
 
 
-def save_rwr(g, stem):
-    with open(f"{stem}.rwr.csv", "w") as file:
-        writer = csv.writer(file, lineterminator="\n")
-        for e in g.iter_edges():
-            writer.writerow(
-                [g.vp["name"][e[0]], g.vp["name"][e[1]]]
-            )  # raw edge values are hashed vertex names
-
-
 def save(g, stem, format):
     """
     Saves a graph_tools Graph object in a specified format
@@ -114,8 +105,6 @@ def save(g, stem, format):
         save_domino(g=g, stem=stem)
     elif format == "robust":
         save_robust(g=g, stem=stem)
-    elif format == "rwr":
-        save_rwr(g=g, stem=stem)
     else:
         logger.critical(f"Unknown output format: {format}")
         sys.exit(1)
@@ -159,7 +148,7 @@ def parse_args(argv=None):
         "-f",
         "--format",
         help="Output format (default gt). If format it gt, a summary file for multiqc will be generated as well.",
-        choices=("gt", "diamond", "domino", "robust", "rwr"),
+        choices=("gt", "diamond", "domino", "robust"),
         default="gt",
     )
     parser.add_argument(
@@ -10,17 +10,21 @@
 # in the protein interaction network.
 ###############################################################
 import logging
+import multiprocessing
 import os
 import pickle
 import random
+import statistics
+import tempfile
 import time
 import sys
 import numpy
 import configparser
-import networkx as nx
 import pandas as pd
 import graph_tool.all as gt
-import pyintergraph
+import util
+
+MEASURES = ("closest", "shortest", "kernel", "centre", "separation")
 
 
 def run_proximity(
@@ -35,107 +39,500 @@ def run_proximity(
     phenotype_to_info=None,
     network_dump_file=None,
     skip_no_targets_in_module=False,
+    n_jobs=1,
+    sampler="legacy",
+    output_formats=("tsv",),
+    flush_rows=10000,
+    matrix_file=None,
+    adaptive=False,
+    batch_size=100,
+    z_threshold=-2.0,
+    confidence=0.99,
+    measures=("closest",),
 ):
     """
     Run proximity on each gene set using the provided targets, output is saved
-    in a text file
+    in a text file. network is a networkx graph or (node names, node degrees) as
+    returned by parse_network. With n_jobs > 1 the drugs are distributed over a process pool.
+    The degree-aware random sets are drawn by the "legacy" sampler (random.choice with
+    retries) or the "exact" sampler (correctly sized, numpy.random.Generator based).
+    Output rows are buffered and written every flush_rows rows, output_formats can add
+    "parquet" next to the TSV file. If matrix_file is given, the z-scores are also
+    written as drug x gene set matrix.
+    In adaptive mode the random sets are scored in batches of batch_size and scoring
+    stops once the confidence interval of z lies on one side of z_threshold; the
+    number of random sets used and whether scoring stopped early are reported.
+    measures selects the distance measures (see MEASURES), each gets its own null
+    distribution from the same random sets. With other measures than "closest" the
+    output has one row per measure, adaptive mode and matrix_file use the first one.
     """
+    unknown = set(measures) - set(MEASURES)
+    if unknown:
+        raise ValueError(f"Unknown proximity measures: {sorted(unknown)}")
+    long_format = list(measures) != ["closest"]
     # Get network
-    nodes_network = set(network.nodes())
+    names, degrees = network_arrays(network)
+    nodes_network = set(names)
     # Get shortest paths
     # Get degree binning
 
     lengths = get_shortest_paths(network_dump_file)
+    distances, row_index, col_index = lengths
+
+    bins = get_degree_binning(zip(names, degrees), min_bin_size, lengths)
+    bin_index = index_degree_bins(bins, col_index)
+    with_stats = "centre" in measures or "separation" in measures
+    if with_stats and row_index is not col_index:
+        raise ValueError(
+            "The centre and separation measures need distances between all nodes, "
+            "not only from the drug targets"
+        )
+
+    # The random reference sets only depend on the module, draw them once per module
+    # and keep them as column indices of the distance matrix. Modules that would get
+    # the same sets (same genes, or same size without degree_aware) share them.
+    phenotype_to_sets = {}
+    shared_sets = {}
+    for phenotype, genes in phenotype_to_genes.items():
+        genes = list(sorted(set(genes) & nodes_network))
+        if len(genes) == 0:
+            # logging.info("Skipping: {}".format(phenotype))
+            continue
+        gene_indices = nodes_to_indices([genes], col_index)
+        if degree_aware:
+            key = (sampler, tuple(gene_indices[0]))
+        else:
+            key = ("uniform", len(genes))
+        gene_stats = gene_set_stats(distances, gene_indices) if with_stats else None
+        if key in shared_sets:
+            phenotype_to_sets[phenotype] = (gene_indices, gene_stats) + shared_sets[key]
+            continue
+        if degree_aware and sampler == "exact":
+            random_gene_sets = pick_random_indices_exact(
+                bin_index, gene_indices[0], n_random=n_random, seed=seed
+            )
+        elif degree_aware and sampler == "legacy":
+            random_gene_sets = pick_random_indices_matching_selected(
+                bin_index, gene_indices[0], n_random=n_random, seed=seed
+            )
+        elif degree_aware:
+            raise ValueError(f"Unknown sampler: {sampler}")
+        else:
+            random_gene_sets = pick_random_nodes(
+                list(names), len(genes), n_random=n_random, seed=seed
+            )
+            random_gene_sets = nodes_to_indices(random_gene_sets, col_index)
+        # print(random_gene_sets[0]) # for testing
+        random_stats = (
+            gene_set_stats(distances, random_gene_sets) if with_stats else None
+        )
+        shared_sets[key] = (random_gene_sets, random_stats)
+        phenotype_to_sets[phenotype] = (gene_indices, gene_stats) + shared_sets[key]
+    logging.info(
+        f"{len(shared_sets)} random reference distributions for {len(phenotype_to_sets)} gene sets"
+    )
 
-    bins = get_degree_binning(network, min_bin_size, lengths)
-
-    k = 1
-    f = init_outFile(output_file, phenotype_to_info)
+    drug_to_rows = {}
     for drug, targets in drug_to_targets.items():
         targets = set(targets) & nodes_network
 
         if len(targets) == 0:
             continue
 
-        for phenotype, genes in phenotype_to_genes.items():
-            logging.info("{}/{} {}".format(k, len(phenotype_to_genes), phenotype))
-            t1 = time.perf_counter()
-            k += 1
-
-            genes = list(sorted(set(genes) & nodes_network))
-            if len(genes) == 0:
-                # logging.info("Skipping: {}".format(phenotype))
-                continue
+        missing = targets - row_index.keys()
+        if missing:
+            raise ValueError(
+                f"Targets of {drug} are not rows of the shortest paths file: {sorted(missing)[:5]}"
+            )
+        targets = sorted(targets, key=row_index.get)
+        drug_to_rows[drug] = (
+            [row_index[node] for node in targets],
+            [col_index[node] for node in targets],
+        )
+
+    if n_jobs > 1 and not isinstance(distances, numpy.memmap):
+        # workers attach to a memory-mapped copy instead of each holding the matrix
+        fd, shared_file = tempfile.mkstemp(suffix=".spd", dir=".")
+        os.close(fd)
+        shared = util.create_distance_matrix(
+            shared_file, list(row_index), list(col_index)
+        )
+        shared[:] = distances
+        shared.flush()
+        del shared
+    else:
+        shared_file = network_dump_file
+
+    scoring = {"measures": tuple(measures)}
+    if adaptive:
+        scoring |= {
+            "batch_size": batch_size,
+            "z_threshold": z_threshold,
+            "critical": statistics.NormalDist().inv_cdf(0.5 + confidence / 2),
+        }
 
-            d = calculate_min_avg_distance(network, targets, genes, lengths)
-            # print(phenotype, len(genes), d)
-            random_gene_sets = pick_random_nodes_matching_selected(
-                network,
-                bins,
-                genes,
-                n_random=n_random,
-                degree_aware=degree_aware,
-                seed=seed,
+    k = 1
+    z_scores = {}
+    f = init_outFile(
+        output_file,
+        phenotype_to_info,
+        output_formats,
+        flush_rows,
+        adaptive,
+        long_format,
+    )
+    pool = None
+    try:
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(
+                n_jobs,
+                initializer=init_worker,
+                initargs=(shared_file, phenotype_to_sets, scoring),
             )
-            # print(random_gene_sets[0]) # for testing
-            values = numpy.empty(n_random)
-            for i, nodes_random in enumerate(random_gene_sets):
-                values[i] = calculate_min_avg_distance(
-                    network, targets, nodes_random, lengths
+            results = pool.imap(score_drug_worker, drug_to_rows.values())
+        else:
+            results = (
+                score_drug(
+                    numpy.asarray(distances[rows]), cols, phenotype_to_sets, **scoring
                 )
-            m, s = numpy.mean(values), numpy.std(values)
-            if s == 0:
-                z = 0.0
-            else:
-                z = (d - m) / s
+                for rows, cols in drug_to_rows.values()
+            )
 
-            if phenotype_to_info is not None:
-                f.write(
-                    f"{drug}\t{phenotype}\t{z}\t{phenotype_to_info[0]}\t{phenotype_to_info[1]}\t{d}\t{m}\t{s}\n"
-                )
-            else:
-                f.write(f"{drug}\t{phenotype}\t{z}\t{d}\t{m}\t{s}\n")
-            # print(phenotype, len(genes), z, d, m, s)
+        # imap keeps the input order, so the output is deterministic
+        t1 = time.perf_counter()
+        for drug, drug_results in zip(drug_to_rows, results):
+            for phenotype, measure, z, d, m, s, n, early_stop in drug_results:
+                if measure == measures[0]:
+                    z_scores.setdefault(drug, {})[phenotype] = z
+                key = (drug, phenotype, measure) if long_format else (drug, phenotype)
+                if phenotype_to_info is not None:
+                    row = key + (
+                        z,
+                        phenotype_to_info[0],
+                        phenotype_to_info[1],
+                        d,
+                        m,
+                        s,
+                    )
+                else:
+                    row = key + (z, d, m, s)
+                if adaptive:
+                    row += (n, early_stop)
+                f.write(row)
+                # print(phenotype, len(genes), z, d, m, s)
 
-            f.flush()
             t2 = time.perf_counter()
-            logging.info(f"Completed in {t2-t1:.4f}s")
-
-    f.close()
+            logging.info(f"{k}/{len(drug_to_rows)} {drug} completed in {t2-t1:.4f}s")
+            t1 = t2
+            k += 1
+    finally:
+        f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if shared_file != network_dump_file:
+            os.remove(shared_file)
+
+    if matrix_file is not None:
+        matrix = pd.DataFrame.from_dict(
+            z_scores, orient="index", columns=list(phenotype_to_sets)
+        )
+        matrix.to_csv(matrix_file, sep="\t", index_label="drug")
     return None
 
 
+def score_drug(
+    target_distances,
+    target_cols,
+    phenotype_to_sets,
+    measures=("closest",),
+    batch_size=None,
+    z_threshold=-2.0,
+    critical=2.576,
+):
+    """
+    Score one drug against every module. target_distances holds the distance rows
+    of the drug targets, target_cols their column indices. Returns
+    (phenotype, measure, z, d, m, s, n, early_stop) per module and measure.
+    Random reference sets shared by several modules are only scored once.
+    With batch_size, the random sets are scored batch by batch until the interval
+    z +- critical * se(z) of the first measure excludes z_threshold, using the large
+    sample standard error se(z) ~ sqrt((1 + z^2 / 2) / n) of a z-score with estimated
+    mean and sd.
+    """
+    results = []
+    reference = {}
+    if "separation" in measures:
+        target_within = calculate_within_distance(target_distances[:, target_cols])
+    else:
+        target_within = 0.0
+    for phenotype, (
+        genes,
+        gene_stats,
+        random_gene_sets,
+        random_stats,
+    ) in phenotype_to_sets.items():
+        d = calculate_distance_measures(
+            target_distances, genes, measures, gene_stats, target_within
+        )
+        # print(phenotype, len(genes), d)
+        values = reference.get(
+            id(random_gene_sets), {measure: numpy.empty(0) for measure in measures}
+        )
+        n_total = len(random_gene_sets)
+        n = 0
+        early_stop = False
+        while n < n_total:
+            n = n_total if batch_size is None else min(n + batch_size, n_total)
+            scored = len(values[measures[0]])
+            if scored < n:
+                batch = calculate_distance_measures(
+                    target_distances,
+                    random_gene_sets[scored:n],
+                    measures,
+                    slice_set_stats(random_stats, scored, n),
+                    target_within,
+                )
+                values = {
+                    measure: numpy.concatenate([values[measure], batch[measure]])
+                    for measure in measures
+                }
+                reference[id(random_gene_sets)] = values
+            scores = {}
+            for measure in measures:
+                m = numpy.mean(values[measure][:n])
+                s = numpy.std(values[measure][:n])
+                if s == 0:
+                    z = 0.0
+                else:
+                    z = (d[measure][0] - m) / s
+                scores[measure] = (z, d[measure][0], m, s)
+            z = scores[measures[0]][0]
+            if n < n_total and abs(z - z_threshold) > critical * numpy.sqrt(
+                (1 + z**2 / 2) / n
+            ):
+                early_stop = True
+                break
+        for measure in measures:
+            results.append((phenotype, measure) + scores[measure] + (n, early_stop))
+    return results
+
+
+_worker = {}
+
+
+def init_worker(dump_file, phenotype_to_sets, scoring):
+    """
+    Pool initializer, memory-maps the distance matrix so all workers share the page cache.
+    """
+    _worker["distances"] = get_shortest_paths(dump_file)[0]
+    _worker["phenotype_to_sets"] = phenotype_to_sets
+    _worker["scoring"] = scoring
+
+
+def score_drug_worker(task):
+    rows, cols = task
+    return score_drug(
+        numpy.asarray(_worker["distances"][rows]),
+        cols,
+        _worker["phenotype_to_sets"],
+        **_worker["scoring"],
+    )
+
+
 def get_shortest_paths(dump_file):
-    if os.path.exists(dump_file):
+    """
+    Load the shortest path lengths as (distance matrix, row name to index, column name to index).
+    Distance matrix files written by shortest_paths.py are memory-mapped, legacy pickled
+    dicts of dicts are converted into an in-memory matrix.
+    """
+    if not os.path.exists(dump_file):
+        raise FileNotFoundError(f"Shortest paths file not found: {dump_file}")
+    if os.path.splitext(dump_file)[1] in (".pickle", ".pkl", ".pck", ".pcl"):
         lengths = pickle.load(open(dump_file, "rb"))
-    return lengths
+        nodes = sorted(lengths)
+        node_to_index = {node: i for i, node in enumerate(nodes)}
+        distances = numpy.full(
+            (len(nodes), len(nodes)), util.UNREACHABLE_DISTANCE, dtype=numpy.uint8
+        )
+        for node_from, vals in lengths.items():
+            row = distances[node_to_index[node_from]]
+            for node_to, val in vals.items():
+                row[node_to_index[node_to]] = val
+        return distances, node_to_index, node_to_index
+    distances, rows, cols = util.load_distance_matrix(dump_file)
+    row_index = {node: i for i, node in enumerate(rows)}
+    col_index = row_index if rows is cols else {node: i for i, node in enumerate(cols)}
+    return distances, row_index, col_index
+
+
+def calculate_distance_measures(
+    target_distances,
+    node_sets,
+    measures=("closest",),
+    set_stats=None,
+    target_within=0.0,
+    max_elements=2**26,
+):
+    """
+    Calculate several distance measures between the targets and many node sets from
+    one gather of the distance block of shape (targets, batch, set size) per batch:
+    closest: average distance of the targets to the closest node of the set
+    shortest: average distance between the targets and the set nodes
+    kernel: -average over the targets of log(mean(exp(-(distance + 1))))
+    centre: average distance of the targets to the closest centre of the set
+    separation: closest distance in both directions minus the within distances
+    centre and separation need the set_stats of node_sets (see gene_set_stats),
+    separation also the within distance of the targets. Returns measure -> values.
+    max_elements bounds the bytes of the temporaries per batch: kernel and centre
+    work on float64 copies of the block, so their batches are 8 times smaller.
+    """
+    if not isinstance(node_sets, numpy.ndarray):
+        # sets of different sizes cannot be stacked into one index array
+        values = {
+            measure: numpy.full(len(node_sets), numpy.nan) for measure in measures
+        }
+        for i, cols in enumerate(node_sets):
+            if len(cols) == 0:
+                continue
+            stats = slice_set_stats(set_stats, i, i + 1)
+            if stats is not None:
+                stats = (stats[0][0][numpy.newaxis], stats[1])
+            one = calculate_distance_measures(
+                target_distances,
+                numpy.asarray(cols)[numpy.newaxis],
+                measures,
+                stats,
+                target_within,
+            )
+            for measure in measures:
+                values[measure][i] = one[measure][0]
+        return values
+    values = {measure: numpy.empty(len(node_sets)) for measure in measures}
+    if node_sets.size == 0:
+        return values
+    n_targets, set_size = len(target_distances), node_sets.shape[1]
+    itemsize = 8 if {"kernel", "centre"} & set(measures) else 1
+    batch_size = max(1, max_elements // (n_targets * set_size * itemsize))
+    for start in range(0, len(node_sets), batch_size):
+        stop = start + batch_size
+        batch = target_distances[:, node_sets[start:stop]]
+        closest = batch.min(axis=2)
+        for measure in measures:
+            if measure == "closest":
+                result = closest.mean(axis=0)
+            elif measure == "shortest":
+                result = batch.mean(axis=(0, 2))
+            elif measure == "kernel":
+                kernel = batch + 1.0
+                numpy.negative(kernel, out=kernel)
+                numpy.exp(kernel, out=kernel)
+                result = -numpy.log(kernel.mean(axis=2)).mean(axis=0)
+                del kernel
+            elif measure == "centre":
+                result = (
+                    numpy.where(set_stats[0][start:stop], batch, numpy.inf)
+                    .min(axis=2)
+                    .mean(axis=0)
+                )
+            elif measure == "separation":
+                between = (closest.sum(axis=0) + batch.min(axis=0).sum(axis=1)) / (
+                    n_targets + set_size
+                )
+                result = between - (target_within + set_stats[1][start:stop]) / 2
+            else:
+                raise ValueError(f"Unknown proximity measure: {measure}")
+            values[measure][start:stop] = result
+    return values
+
+
+def calculate_within_distance(distances):
+    """
+    Average distance of the nodes of a set to the closest other node of the set,
+    given the square distance block of the set (0 for single nodes).
+    """
+    if len(distances) < 2:
+        return 0.0
+    distances = numpy.array(distances, dtype=float)
+    numpy.fill_diagonal(distances, numpy.inf)
+    return distances.min(axis=1).mean()
+
+
+def gene_set_stats(distances, node_sets, max_elements=2**26):
+    """
+    Node set properties for the centre and separation measures, needs a square
+    distance matrix. Returns (centre mask, within distance) where the mask marks the
+    nodes of each set with the minimal sum of distances to the rest of the set.
+    """
+    if not isinstance(node_sets, numpy.ndarray):
+        stats = [
+            gene_set_stats(distances, numpy.asarray(cols)[numpy.newaxis])
+            for cols in node_sets
+        ]
+        return (
+            [mask[0] for mask, within in stats],
+            numpy.array(
+                [within[0] if len(mask[0]) else numpy.nan for mask, within in stats]
+            ),
+        )
+    n_sets, set_size = node_sets.shape
+    centre = numpy.zeros((n_sets, set_size), dtype=bool)
+    within = numpy.zeros(n_sets)
+    if node_sets.size == 0:
+        return centre, within
+    batch_size = max(1, max_elements // (8 * set_size**2))  # float64 blocks
+    for start in range(0, n_sets, batch_size):
+        sets = node_sets[start : start + batch_size]
+        block = numpy.asarray(
+            distances[sets[:, :, numpy.newaxis], sets[:, numpy.newaxis, :]],
+            dtype=float,
+        )
+        totals = block.sum(axis=2)
+        centre[start : start + batch_size] = totals == totals.min(axis=1, keepdims=True)
+        if set_size > 1:
+            block[:, numpy.arange(set_size), numpy.arange(set_size)] = numpy.inf
+            within[start : start + batch_size] = block.min(axis=2).mean(axis=1)
+    return centre, within
+
+
+def slice_set_stats(set_stats, start, stop):
+    if set_stats is None:
+        return None
+    return set_stats[0][start:stop], set_stats[1][start:stop]
+
+
+def nodes_to_indices(node_sets, node_index):
+    """
+    Map node sets to index arrays. Returns a 2D array if all sets have the same size,
+    a list of 1D arrays otherwise.
+    """
+    return stack_index_sets(
+        [[node_index[node] for node in nodes] for nodes in node_sets]
+    )
 
 
-def calculate_min_avg_distance(network, nodes_from, nodes_to, lengths):
+def stack_index_sets(index_sets):
     """
-    Helper function to calculate avg distance to the closest node
+    Stack index sets into a 2D array if all sets have the same size, otherwise
+    returns a list of 1D arrays.
     """
-    values_outer = []
-    for node_from in nodes_from:
-        values = []
-        vals = lengths[node_from]
-        for node_to in nodes_to:
-            val = vals[node_to]
-            values.append(val)
-        d = min(values)
-        values_outer.append(d)
-    d = numpy.mean(values_outer)
-    return d
+    node_sets = [numpy.array(nodes, dtype=numpy.int64) for nodes in index_sets]
+    if len(node_sets) == 0:
+        return numpy.empty((0, 0), dtype=numpy.int64)
+    if len({len(nodes) for nodes in node_sets}) == 1:
+        return numpy.array(node_sets)
+    return node_sets
 
 
-def get_degree_binning(g, bin_size, lengths=None):
+def get_degree_binning(node_degrees, bin_size, lengths=None):
     """
-    Helper function to bin nodes based on their degree
+    Helper function to bin nodes based on their degree, node_degrees yields
+    (node, degree) pairs (e.g. networkx graph.degree())
     """
     degree_to_nodes = {}
-    for node, degree in g.degree():
+    for node, degree in node_degrees:
         # if lengths is given, it will only use those nodes
-        if lengths is not None and node not in lengths:
+        if lengths is not None and node not in lengths[2]:
             continue
         degree_to_nodes.setdefault(degree, []).append(node)
 
@@ -166,81 +563,181 @@ def get_degree_binning(g, bin_size, lengths=None):
     return bins
 
 
-def pick_random_nodes_matching_selected(
-    network,
-    bins,
-    nodes_selected,
-    n_random,
-    degree_aware=True,
-    connected=False,
-    seed=None,
+def pick_random_nodes(nodes, size, n_random, seed=None):
+    """
+    Pick n_random sets of size nodes uniformly, without regard to the degree.
+    """
+    if seed is not None:
+        random.seed(seed)
+    return [random.sample(nodes, size) for _ in range(n_random)]
+
+
+def index_degree_bins(bins, node_index):
+    """
+    Precompute the degree bins for sampling. Returns the bin id and the position within
+    the bin per node index (-1 for nodes without bin), and the node indices of each bin
+    as NumPy array.
+    """
+    bin_of = numpy.full(len(node_index), -1, dtype=numpy.int64)
+    position = numpy.full(len(node_index), -1, dtype=numpy.int64)
+    bin_nodes = []
+    for i, (low, high, nodes) in enumerate(bins):
+        nodes = numpy.array([node_index[node] for node in nodes], dtype=numpy.int64)
+        bin_of[nodes] = i
+        position[nodes] = numpy.arange(len(nodes))
+        bin_nodes.append(nodes)
+    return bin_of, position, bin_nodes
+
+
+def pick_random_indices_matching_selected(
+    bin_index, nodes_selected, n_random, seed=None
 ):
     """
-    Function to pick random nodes matching the degrees of given nodes.
-    bins variable is generated using get_degree_binning (to get bins)
+    Degree-aware sampling on node indices, bin_index is generated using index_degree_bins.
+    Each selected node is replaced by a random node of its bin other than itself. The
+    node is drawn by index arithmetic (skipping the node's own position) instead of
+    copying the bin, which yields the same draws as random.choice on the bin without
+    the node. Order of entries is important, feed it with the same ordered list.
     """
     if seed is not None:
         random.seed(seed)
+    bin_of, position, bin_nodes = bin_index
+    equivalents = [
+        (bin_nodes[bin_of[node]], position[node], len(bin_nodes[bin_of[node]]) - 1)
+        for node in nodes_selected
+        if bin_of[node] >= 0
+    ]
     values = []
-    nodes = list(network.nodes())
     for _ in range(n_random):
-        if degree_aware:
-            if connected:
-                raise ValueError("Not implemented!")
-            nodes_random = set()
-            node_to_equivalent_nodes = get_degree_equivalents(
-                nodes_selected, bins, network
+        nodes_random = set()
+        for nodes, pos, n in equivalents:
+            j = random.randrange(n)
+            chosen = nodes[j + (j >= pos)]
+            for k in range(20):  # Try to find a distinct node (at most 20 times)
+                if chosen in nodes_random:
+                    j = random.randrange(n)
+                    chosen = nodes[j + (j >= pos)]
+            nodes_random.add(chosen)
+        values.append(list(nodes_random))
+    return stack_index_sets(values)
+
+
+def pick_random_indices_exact(bin_index, nodes_selected, n_random, seed=None):
+    """
+    Degree-aware sampling of n_random node sets of exactly the size of nodes_selected.
+    For every bin, as many nodes as selected nodes fall into the bin are drawn without
+    replacement from the bin's other nodes (as the legacy sampler, the selected nodes
+    themselves are never drawn) for all sets at once (k smallest of uniform random
+    keys per set). The sets are reproducible from seed.
+    """
+    rng = numpy.random.default_rng(seed)
+    bin_of, position, bin_nodes = bin_index
+    bins_selected = bin_of[numpy.asarray(nodes_selected, dtype=numpy.int64)]
+    bin_ids, counts = numpy.unique(
+        bins_selected[bins_selected >= 0], return_counts=True
+    )
+    values = numpy.empty((n_random, counts.sum()), dtype=numpy.int64)
+    start = 0
+    for bin_id, k in zip(bin_ids, counts):
+        nodes = bin_nodes[bin_id]
+        nodes = nodes[~numpy.isin(nodes, nodes_selected)]
+        if len(nodes) < k:
+            raise ValueError(
+                f"Degree bin {bin_id} has fewer than {k} nodes besides the selected "
+                "ones, increase min_bin_size or use the legacy sampler"
             )
-            for node, equivalent_nodes in node_to_equivalent_nodes.items():
-                # nodes_random.append(random.choice(equivalent_nodes))
-                chosen = random.choice(equivalent_nodes)
-                for k in range(20):  # Try to find a distinct node (at most 20 times)
-                    if chosen in nodes_random:
-                        chosen = random.choice(equivalent_nodes)
-                nodes_random.add(chosen)
-            nodes_random = list(nodes_random)
-        else:
-            if connected:
-                nodes_random = [random.choice(nodes)]
-                k = 1
-                while k < len(nodes_selected):
-                    node_random = random.choice(nodes_random)
-                    node_selected = random.choice(
-                        [x for x in network.neighbors(node_random)]
-                    )
-                    if not node_selected in nodes_random:
-                        nodes_random.append(node_selected)
-                        k += 1
-            else:
-                nodes_random = random.sample(nodes, len(nodes_selected))
-        values.append(nodes_random)
+        keys = rng.random((n_random, len(nodes)))
+        chosen = numpy.argpartition(keys, k - 1, axis=1)[:, :k]
+        values[:, start : start + k] = nodes[chosen]
+        start += k
     return values
 
 
-def get_degree_equivalents(seeds, bins, g):
+def init_outFile(
+    output_file,
+    phenotype_to_info,
+    output_formats=("tsv",),
+    flush_rows=1,
+    adaptive=False,
+    long_format=False,
+):
+    columns = ["drug", "phenotype"]
+    if long_format:
+        columns += ["measure"]
+    if phenotype_to_info is not None:
+        columns += ["z", "moa", "consistency", "d", "m", "s"]
+    else:
+        columns += ["z", "d", "m", "s"]
+    if adaptive:
+        columns += ["n_random", "early_stop"]
+    return ProximityWriter(output_file, columns, output_formats, flush_rows)
+
+
+class ProximityWriter:
     """
-    Order of entries are important due to the removal process
-    For reproducibility make sure to feed it with the same ordered list
+    Buffers proximity result rows and writes them in batches of flush_rows rows.
+    Besides the TSV file, the rows can be written to a Parquet file (same name with
+    .parquet extension, requires pyarrow) for column-wise downstream aggregation.
     """
-    seed_to_nodes = {}
-    for seed in seeds:
-        d = g.degree(seed)
-        for l, h, nodes in bins:
-            if l <= d and h >= d:
-                mod_nodes = list(nodes)
-                mod_nodes.remove(seed)
-                seed_to_nodes[seed] = mod_nodes
-                break
-    return seed_to_nodes
 
+    def __init__(self, output_file, columns, output_formats=("tsv",), flush_rows=1):
+        unknown = set(output_formats) - {"tsv", "parquet"}
+        if unknown:
+            raise ValueError(f"Unknown output formats: {unknown}")
+        self.columns = columns
+        self.flush_rows = max(1, flush_rows)
+        self.rows = []
+        self.tsv = None
+        self.parquet_file = None
+        self.parquet = None
+        if "tsv" in output_formats:
+            self.tsv = open(output_file, "w")
+            self.tsv.write("\t".join(columns) + "\n")
+        if "parquet" in output_formats:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError as e:
+                raise ImportError("Parquet output requires pyarrow") from e
+            self.pyarrow = pyarrow
+            self.parquet_file = os.path.splitext(output_file)[0] + ".parquet"
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.tsv is not None:
+            self.tsv.write(
+                "".join("\t".join(map(str, row)) + "\n" for row in self.rows)
+            )
+            self.tsv.flush()
+        if self.parquet_file is not None:
+            table = self.pyarrow.Table.from_pydict(
+                {
+                    column: [
+                        value.item() if isinstance(value, numpy.generic) else value
+                        for value in values
+                    ]
+                    for column, values in zip(self.columns, zip(*self.rows))
+                }
+            )
+            if self.parquet is None:
+                self.parquet = self.pyarrow.parquet.ParquetWriter(
+                    self.parquet_file, table.schema
+                )
+            self.parquet.write_table(table.cast(self.parquet.schema))
+        self.rows = []
 
-def init_outFile(output_file, phenotype_to_info):
-    f = open(output_file, "w")
-    if phenotype_to_info is not None:
-        f.write("drug\tphenotype\tz\tmoa\tconsistency\td\tm\ts\n")
-    else:
-        f.write("drug\tphenotype\tz\td\tm\ts\n")
-    return f
+    def close(self):
+        self.flush()
+        if self.tsv is not None:
+            self.tsv.close()
+        if self.parquet is not None:
+            self.parquet.close()
 
 
 def parse_input_file(f, source_column, target_column, prefix):
@@ -258,7 +755,42 @@ def parse_input_file(f, source_column, target_column, prefix):
     return source_to_targets
 
 
-def parse_network(network_file, id_mapping_file=None):
+def file_prefix(path):
+    """
+    Gene set name for a gene set file, e.g. the module id of a <module>.nodes.tsv file.
+    """
+    name = os.path.basename(path)
+    if name.endswith(".nodes.tsv"):
+        return name[: -len(".nodes.tsv")]
+    return os.path.splitext(name)[0]
+
+
+def parse_network(network_file, id_mapping_file=None, backend="graph-tool"):
+    """
+    Load the largest connected component of the network. The graph-tool backend
+    returns the node names and degrees as arrays, the networkx backend a networkx graph.
+    """
+    if backend == "graph-tool":
+        g = gt.load_graph(network_file)
+        g.set_vertex_filter(gt.label_largest_component(g))
+        g = gt.Graph(g, prune=True)
+        # degrees as in a simple networkx graph
+        gt.remove_parallel_edges(g)
+        names = [g.vp["name"][v] for v in g.iter_vertices()]
+        degrees = g.get_total_degrees(g.get_vertices())
+        if id_mapping_file is not None:
+            with open(id_mapping_file) as mapping:
+                mapping = {
+                    k: gene for k, gene in (l.strip().split("\t") for l in mapping)
+                }
+            names = [mapping.get(name, name) for name in names]
+        return names, degrees
+    if backend != "networkx":
+        raise ValueError(f"Unknown network backend: {backend}")
+
+    import networkx as nx
+    import pyintergraph
+
     g = gt.load_graph(network_file)
     network = pyintergraph.gt2nx(g, labelname="name")
     component_nodes = max(nx.connected_components(network), key=len)
@@ -271,13 +803,22 @@ def parse_network(network_file, id_mapping_file=None):
     return network
 
 
+def network_arrays(network):
+    """
+    Node names and degrees of a networkx graph, (names, degrees) are passed through.
+    """
+    if isinstance(network, tuple):
+        return network
+    return list(network.nodes()), [degree for node, degree in network.degree()]
+
+
 def parseConfigFile(config_file):
     """REQUIRED FILEDS
     drug_to_target
     drug_column
     target_column
 
-    phenotype_to_gene
+    phenotype_to_gene (one or more whitespace-separated files)
     phenotype_column
     gene_column
 
@@ -288,9 +829,20 @@ def parseConfigFile(config_file):
     id_mapping_file = config["PROXIMITY"]["id_mapping_file"]
 
     OPTIONAL
+    n_jobs: default 1
+    backend: default graph-tool (or networkx)
     n_random: default 1000
     min_bin_size: default 100
     random_seed: default 51234
+    sampler: default legacy (or exact)
+    output_formats: default tsv (comma-separated, tsv and/or parquet)
+    flush_rows: default 10000
+    matrix_file: None (path for the drug x gene set z-score matrix)
+    adaptive: default False (stop scoring random sets once z is clearly on one side of z_threshold)
+    batch_size: default 100 (random sets per step in adaptive mode)
+    z_threshold: default -2.0
+    confidence: default 0.99
+    measures: default closest (comma-separated, closest, shortest, kernel, centre, separation)
     shortest_path_file: None
     """
 
@@ -304,6 +856,17 @@ def parseConfigFile(config_file):
                 "min_bin_size": "100",
                 "random_seed": "51234",
                 "degree_aware": "True",
+                "n_jobs": "1",
+                "backend": "graph-tool",
+                "sampler": "legacy",
+                "output_formats": "tsv",
+                "flush_rows": "10000",
+                "matrix_file": "None",
+                "adaptive": "False",
+                "batch_size": "100",
+                "z_threshold": "-2.0",
+                "confidence": "0.99",
+                "measures": "closest",
             }
         }
     )
@@ -316,6 +879,9 @@ def parseConfigFile(config_file):
         config["id_mapping_file"] = None
     if config["phenotype_column"] == "None":
         config["phenotype_column"] = None
+    if config["matrix_file"] == "None":
+        config["matrix_file"] = None
+    config["adaptive"] = config["adaptive"] == "True"
     if config["degree_aware"] == "True":
         config["degree_aware"] = True
     else:
@@ -331,22 +897,30 @@ def main():
         config["drug_to_target"], config["drug_column"], config["target_column"], None
     )
 
-    phenotype_to_genes = parse_input_file(
-        config["phenotype_to_gene"],
-        config["phenotype_column"],
-        config["gene_column"],
-        config["prefix"],
+    # several whitespace-separated gene set files are scored together; a grouped
+    # task (one with a matrix_file) names every gene set by its file, even if the
+    # group holds a single module
+    phenotype_files = config["phenotype_to_gene"].split()
+    grouped = config["matrix_file"] is not None or len(phenotype_files) > 1
+    phenotype_to_genes = {}
+    for phenotype_file in phenotype_files:
+        phenotype_to_genes |= parse_input_file(
+            phenotype_file,
+            config["phenotype_column"],
+            config["gene_column"],
+            file_prefix(phenotype_file) if grouped else config["prefix"],
+        )
+
+    network = parse_network(
+        config["network_file"], config["id_mapping_file"], config["backend"]
     )
-
-    network = parse_network(config["network_file"], config["id_mapping_file"])
+    names, degrees = network_arrays(network)
 
     logging.info(
         f"Config file: {config_file}\ngene_set_file: {config['phenotype_to_gene']}\nTargets: {config['drug_to_target']}\n"
     )
     logging.debug(f"{len(phenotype_to_genes)} , {list(phenotype_to_genes.items())[:4]}")
-    logging.debug(
-        f"{len(network.nodes())} {len(network.edges())} {list(network.edges())[:4]}"
-    )
+    logging.debug(f"{len(names)} {sum(degrees) // 2} {list(names)[:4]}")
 
     run_proximity(
         drug_to_target,
@@ -358,6 +932,16 @@ def main():
         seed=int(config["random_seed"]),
         degree_aware=config["degree_aware"],
         network_dump_file=config["shortest_paths"],
+        n_jobs=int(config["n_jobs"]),
+        sampler=config["sampler"],
+        output_formats=[x.strip() for x in config["output_formats"].split(",")],
+        flush_rows=int(config["flush_rows"]),
+        matrix_file=config["matrix_file"],
+        adaptive=config["adaptive"],
+        batch_size=int(config["batch_size"]),
+        z_threshold=float(config["z_threshold"]),
+        confidence=float(config["confidence"]),
+        measures=[x.strip() for x in config["measures"].split(",")],
     )
 
 
@@ -1,105 +1,184 @@
 #! /usr/bin/env python
 
 
+import argparse
+from collections import deque
+import os
+import graph_tool.all as gt
 import networkx as nx
 import numpy as np
+import scipy.linalg
 import scipy.sparse as sp
 from scipy.sparse import linalg
 import sys
 import csv
+import util
+
+SOLVERS = ("splu", "gmres", "power", "push", "dense")
+PRECISIONS = ("float64", "float32")
 
 
 # =============================================================================
 
 
-def print_usage():
-    print("")
-    print(
-        "        usage: ./rwr.py network_edgelist_file seeds_file scaling symmetrical r(optional)"
+def parse_args(argv=None):
+    """Define and immediately parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Random walk with restart from seed genes on the largest connected component.",
+        epilog="Example: python rwr.py network.csv seeds.txt 0 1 0.8",
     )
-    print("        -----------------------------------------------------------------")
-    print(
-        "        network_file : The edgelist must be provided as any delimiter-separated"
+    parser.add_argument(
+        "network_file",
+        help="The network as graph file (e.g. .gt) or the edgelist as any "
+        "delimiter-separated table, the first two columns are interpreted as an "
+        "interaction gene1 <==> gene2. Make sure the delimiter does not exist in "
+        "gene IDs and is consistent across the file.",
+        type=str,
     )
-    print(
-        "                       table. Make sure the delimiter does not exit in gene IDs"
+    parser.add_argument(
+        "seeds_file",
+        help="Table containing the seed genes (tab-separated, the first column is used). "
+        "Several comma-separated files are solved together, their outputs are prefixed "
+        "with the seed file name.",
+        type=str,
     )
-    print("                       and is consistent across the file.")
-    print("                       The first two columns of the table will be")
-    print("                       interpreted as an interaction gene1 <==> gene2")
-    print("        seed_file    : Table containing the seed genes (if table contains")
-    print("                       more than one column they must be tab-separated;")
-    print("                       the first column will be used only).")
-    print(
-        "        scaling      : (0 or 1) value to allow (1) the scaling the nodes' visiting"
+    parser.add_argument(
+        "scaling",
+        help="(0 or 1) scale the nodes' visiting probabilities by the sqrt of their "
+        "degree (1) or not (0).",
+        type=int,
+        choices=(0, 1),
     )
-    print(
-        "                       probabilities by the sqrt of their degree or not (0)."
+    parser.add_argument(
+        "symmetrical",
+        help="(0 or 1) use the symmetric Markov matrix (1) instead of the column-wise "
+        "normalized Markov matrix (0).",
+        type=int,
+        choices=(0, 1),
     )
-    print(
-        "        symmetrical  : (0 or 1) value for the use of the symmetric Markov matrix (1)"
+    parser.add_argument(
+        "r",
+        help="Damping factor/restart probability for the random walk (default 0.8).",
+        type=float,
+        nargs="?",
+        default=0.8,
     )
-    print(
-        "                       (instead of the column-wise normalized Markov matrix (0))"
+    parser.add_argument(
+        "-s",
+        "--solver",
+        help="How to solve (I - (1-r) M) x = r p0: by inverting the dense matrix (dense), "
+        "sparse LU (splu), GMRES (gmres), power iteration (power) or approximate local "
+        "push from the seeds (push) (default dense). The LU factors fill in, on "
+        "scale-free networks up to O(N^2) memory and slower than dense, the iterative "
+        "solvers stay O(E). Other solvers than dense may swap genes with tied "
+        "visiting probability.",
+        choices=SOLVERS,
+        default="dense",
     )
-    print(
-        "        r            : damping factor/restart probability for the random walk,"
+    parser.add_argument(
+        "-a",
+        "--alpha",
+        help="Teleportation probability of the column-wise random walk (default 1, "
+        "no teleportation).",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--tol",
+        help="Relative tolerance of the gmres and power solvers (default 1e-10).",
+        type=float,
+        default=1e-10,
+    )
+    parser.add_argument(
+        "--epsilon",
+        help="Error tolerance of the push solver: nodes whose residual exceeds epsilon "
+        "times their degree times the seed mass are pushed (default 1e-7).",
+        type=float,
+        default=1e-7,
+    )
+    parser.add_argument(
+        "-c",
+        "--cache-dir",
+        help="Directory of cached splu factorizations, keyed by the fingerprint of the "
+        "network's edge list, r, alpha and symmetrical. The factors are large because "
+        "of fill-in (about 0.5 GB for an 8,000-node scale-free graph, several GB for a "
+        "17k-node PPI).",
+        type=str,
+    )
+    parser.add_argument(
+        "-p",
+        "--precision",
+        help="Floating point precision of the RW operator and the solve, float32 halves "
+        "the memory (default float64).",
+        choices=PRECISIONS,
+        default="float64",
+    )
+    parser.add_argument(
+        "--report-deviation",
+        help="Also solve in float64 and report the max deviation of the visiting "
+        "probabilities and of the ranking of the module genes.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--name-by-seeds",
+        help="Prefix the output with the seed file name also for a single seed file.",
+        action="store_true",
     )
-    print("                       default is set to 0.8.")
-    print(" ")
+    return parser.parse_args(argv)
 
 
-# =============================================================================
+def get_outfile_name(scaling, symmetrical, r):
+    sc = ["no_scaling", "scaling"]
+    sy = ["columwise", "symmetrical"]
 
+    return f"connected_module_rwr_{sc[scaling]}_{sy[symmetrical]}_{r}.txt"
 
-def check_input_style(input_list):
-    try:
-        network_edgelist_file = input_list[1]
-        seeds_file = input_list[2]
-        scaling = int(input_list[3])
-        symmetrical = int(input_list[4])
-    # if no input is given, print out a usage message and exit
-    except:
-        print_usage()
-        sys.exit(0)
-        return
 
-    r = 0.8
+# =============================================================================
 
-    if len(input_list) == 6:
-        try:
-            r = float(input_list[5])
-        except:
-            print_usage()
-            sys.exit(0)
-            return
 
-    sc = ["no_scaling", "scaling"]
-    sy = ["columwise", "symmetrical"]
+def read_input(network_file, seed_file):
+    """
+    Reads the network (see read_network) and the list of seed genes (see read_seeds)
+    from external files.
 
-    outfile_name = f"connected_module_rwr_{sc[scaling]}_{sy[symmetrical]}_{r}.txt"
+    Returns:
+        A:          (scipy csr matrix) adjacency matrix of the largest connected
+                    component, nodes in sorted order
+        nodes:      (numpy array) sorted node names
+        seed_genes: (set) seed genes
+    """
 
-    return network_edgelist_file, seeds_file, scaling, symmetrical, r, outfile_name
+    A, nodes = read_network(network_file)
+    return A, nodes, read_seeds(seed_file)
 
 
 # =============================================================================
 
 
-def read_input(network_file, seed_file):
+def read_network(network_file):
     """
-    Reads the network and the list of seed genes from external files.
+    Reads the network and returns the adjacency matrix of its largest connected
+    component with the nodes in sorted order.
+
+    * A graph file (.gt, .graphml, .xml, .dot, .gml) is loaded with graph-tool and
+    the adjacency matrix is built from its edge array, vertex names are taken from
+    the "name" vertex property.
 
-    * The edgelist must be provided as a tab-separated table. The
+    * Otherwise the edgelist must be provided as a delimiter-separated table. The
     first two columns of the table will be interpreted as an
     interaction gene1 <==> gene2
 
-    * The seed genes mus be provided as a table. If the table has more
-    than one column, they must be tab-separated. The first column will
-    be used only.
-
-    * Lines that start with '#' will be ignored in both cases
+    * Lines that start with '#' will be ignored
     """
 
+    if os.path.splitext(network_file)[1] in [".gt", ".graphml", ".xml", ".dot", ".gml"]:
+        g = util.load_graph(network_file)
+        g.set_vertex_filter(gt.label_largest_component(g, directed=False))
+        g = gt.Graph(g, prune=True)
+        names = np.array([g.vp["name"][v] for v in g.iter_vertices()])
+        return adjacency_from_edges(names, g.get_edges())
+
     sniffer = csv.Sniffer()
     line_delimiter = None
     for line in open(network_file, "r"):
@@ -131,6 +210,48 @@ def read_input(network_file, seed_file):
         max(nx.connected_components(G), key=len)
     )  # extract lcc graph
 
+    nodes = sorted(G_connected.nodes())
+    A = sp.csr_matrix(nx.adjacency_matrix(G_connected, nodes), dtype=float)
+    return A, np.array(nodes)
+
+
+# =============================================================================
+
+
+def adjacency_from_edges(names, edges):
+    """
+    Build the symmetric 0/1 adjacency matrix (duplicate edges merged, as in a
+    networkx Graph) from an edge array of vertex indices, nodes in sorted order.
+
+    Parameters:
+        names:  (numpy array) vertex names
+        edges:  (numpy array) edges as rows of (source, target) vertex indices
+
+    Returns:
+        A:      (scipy csr matrix) adjacency matrix
+        nodes:  (numpy array) sorted node names
+    """
+
+    order = np.argsort(names, kind="stable")
+    rank = np.empty(len(names), dtype=int)
+    rank[order] = np.arange(len(names))
+    rows, cols = rank[edges[:, 0]], rank[edges[:, 1]]
+    A = sp.csr_matrix(
+        (np.ones(2 * len(rows)), (np.r_[rows, cols], np.r_[cols, rows])),
+        shape=(len(names), len(names)),
+    )
+    A.data[:] = 1.0
+    return A, names[order]
+
+
+# =============================================================================
+
+
+def read_seeds(seed_file):
+    """
+    Reads the list of seed genes (first column, lines starting with '#' are ignored).
+    """
+
     # read the seed genes:
     seed_genes = set()
     for line in open(seed_file, "r"):
@@ -143,58 +264,52 @@ def read_input(network_file, seed_file):
         seed_gene = line_data[0]
         seed_genes.add(seed_gene)
 
-    return G_connected, seed_genes
+    return seed_genes
 
 
 # =============================================================================
 
 
-def colwise_rnd_walk_matrix(G, r, a):
+def colwise_rnd_walk_matrix(A, r, a, dtype=np.float64):
     """
-    Compute the Random Walk Matrix (RWM) for a given graph G with teleportation
+    Compute the Random Walk Matrix (RWM) for a given graph with teleportation
     probability a and damping factor r using the formula (I-r*M)^-1 where M is
-    the column-wise normalized Markov matrix according to M = A D^{-1}
+    the column-wise normalized Markov matrix according to M = A D^{-1}. The dense
+    matrix is only formed in dtype, the teleportation term is added in place.
 
     Parameters:
-        G: (networkx graph) input graph
+        A: (scipy sparse matrix) adjacency matrix of the input graph
         r: (float) damping factor/restart probability
         a: (float) teleportation probability
+        dtype: (numpy dtype) precision of the inversion
 
     Returns:
-        W: (numpy array) RWM of the input graph G
+        W: (numpy array) RWM of the input graph
 
     """
 
-    # get the number of nodes in the graph G
-    n = G.number_of_nodes()
-    # get the adjacency matrix of graph G
-    A = nx.adjacency_matrix(G, sorted(G.nodes()))
-    A = sp.csc_matrix(A)
+    # get the number of nodes in the graph
+    n = A.shape[0]
 
-    # calculate the first scaling term
-    factor = float((1 - a) / n)
+    # compute the column-wise normalized Markov matrix, sparse part and rank one
+    # teleportation term
+    M, teleport = markov_matrix(A, False, a=a)
 
-    # prepare the second scaling term
-    E = sp.csc_matrix(factor * np.ones([n, n]))
-    A_tele = (a * A) + E
-
-    # compute the column-wise normalized Markov matrix
-    norm = linalg.norm(A_tele, ord=1, axis=0)
-    M = A_tele / norm
-
-    # mixture of Markov chains
-    del A_tele
-    del E
-
-    U = sp.identity(n, dtype=int)
-    H = (1 - r) * M
-    H1 = U - H
-    del U
+    # I - (1-r) M, densified in dtype
+    H1 = ((1 - r) * M).astype(dtype).toarray()
     del M
-    del H
+    np.negative(H1, out=H1)
+    H1[np.diag_indices(n)] += 1
+    if teleport is not None:
+        u, v = teleport
+        v = ((1 - r) * v).astype(dtype)
+        for i in range(n):
+            H1[i] -= u[i] * v
 
     # compute the RWM using the formula (I-r*P)^-1
-    W = r * np.linalg.inv(H1.toarray())
+    W = invert_dense(H1)
+    del H1
+    W *= r
 
     return W
 
@@ -202,26 +317,27 @@ def colwise_rnd_walk_matrix(G, r, a):
 # =============================================================================
 
 
-def symmetric_rnd_walk_matrix(G, r):
+def symmetric_rnd_walk_matrix(A, r, dtype=np.float64):
     """
-    Compute the Random Walk Matrix (RWM) for a given graph G damping factor r
+    Compute the Random Walk Matrix (RWM) for a given graph with damping factor r
     using the formula (I-r*M_s)^-1 where M_s is the symmetric Markov matrix
     according to M_s = D^{-1/2} A D^{-1/2} = I - Laplace_normalized
 
     Parameters:
-        G: (networkx graph) input graph
+        A: (scipy sparse matrix) adjacency matrix of the input graph
         r: (float) damping factor/restart probability
+        dtype: (numpy dtype) precision of the inversion
 
     Returns:
-        W: (numpy array) RWM of the input graph G
+        W: (numpy array) RWM of the input graph
 
     """
 
-    # get the number of nodes in the graph G
-    n = G.number_of_nodes()
+    # get the number of nodes in the graph
+    n = A.shape[0]
 
     # generate symmetric Markov matrix
-    M_laplace = nx.normalized_laplacian_matrix(G, sorted(G.nodes()))
+    M_laplace = normalized_laplacian_matrix(A)
     M_Laplace = sp.csc_matrix(M_laplace)
     del M_laplace
 
@@ -230,12 +346,14 @@ def symmetric_rnd_walk_matrix(G, r):
     del M_Laplace
 
     H = (1 - r) * M_s
-    H1 = Id - H
+    H1 = (Id - H).astype(dtype).toarray()
     del M_s
     del H
 
     # compute the RWM using the formula (I-r*M_s)^-1
-    W = r * np.linalg.inv(H1.toarray())
+    W = invert_dense(H1)
+    del H1
+    W *= r
 
     return W
 
@@ -243,12 +361,316 @@ def symmetric_rnd_walk_matrix(G, r):
 # =============================================================================
 
 
-def create_mapping_index_entrezID(G):
+def invert_dense(H1):
+    """
+    Invert the dense matrix H1 in its precision. numpy.linalg.inv works in float64
+    internally, so single precision is inverted with LAPACK's single precision
+    routines (scipy), overwriting H1.
+    """
+
+    if H1.dtype == np.float64:
+        return np.linalg.inv(H1)
+    return scipy.linalg.inv(H1, overwrite_a=True, check_finite=False)
+
+
+# =============================================================================
+
+
+def normalized_laplacian_matrix(A):
+    """
+    Compute the normalized Laplacian I - D^{-1/2} A D^{-1/2} of the adjacency
+    matrix A, as networkx.normalized_laplacian_matrix.
+    """
+
+    n = A.shape[0]
+    diags = np.asarray(A.sum(axis=1)).ravel()
+    D = sp.diags(diags, format="csr")
+    L = D - A
+    with np.errstate(divide="ignore"):
+        diags_sqrt = 1.0 / np.sqrt(diags)
+    diags_sqrt[np.isinf(diags_sqrt)] = 0
+    DH = sp.diags(diags_sqrt, format="csr")
+    return DH @ (L @ DH)
+
+
+# =============================================================================
+
+
+def markov_matrix(A, symmetrical, a=1.0):
+    """
+    Compute the sparse Markov matrix of a graph, either the column-wise normalized
+    M = A_tele D^{-1} with A_tele = a*A + (1-a)/n * 1 1^T, or the symmetric
+    M_s = D^{-1/2} A D^{-1/2}. The teleportation part of the column-wise matrix is
+    rank one and returned as vectors (u, v) with M = M_sparse + u v^T, so that it
+    never has to be formed densely.
+
+    Parameters:
+        A:              (scipy sparse matrix) adjacency matrix of the input graph
+        symmetrical:    (boolean) symmetric Markov matrix if True
+        a:              (float) teleportation probability (column-wise only)
+
+    Returns:
+        M:          (scipy csc matrix) sparse part of the Markov matrix, nodes in
+                    sorted order
+        teleport:   (tuple) vectors (u, v) of the rank one part, None if a = 1
+
+    """
+
+    n = A.shape[0]
+    if symmetrical:
+        M_laplace = sp.csc_matrix(normalized_laplacian_matrix(A))
+        return sp.identity(n, format="csc") - M_laplace, None
+
+    A = sp.csc_matrix(A, dtype=float)
+    # the column sums of A_tele: a * degree + n * (1-a)/n
+    norm = a * np.asarray(abs(A).sum(axis=0)).ravel() + (1 - a)
+    M = (a * A) @ sp.diags(1.0 / norm, format="csc")
+    if a == 1.0:
+        return M, None
+    return M, (np.full(n, (1 - a) / n), 1.0 / norm)
+
+
+# =============================================================================
+
+
+def solve_rnd_walk(M, r, p0, solver="splu", tol=1e-10, teleport=None, lu=None):
+    """
+    Compute the visiting probabilities r (I-(1-r)M)^-1 p0 by solving the sparse
+    linear system (I-(1-r)M) x = r p0 instead of inverting the dense matrix.
+    A rank one teleportation term M + u v^T is applied implicitly, with the
+    Sherman-Morrison formula for splu and inside the operator otherwise.
+
+    Parameters:
+        M:          (scipy sparse matrix) Markov matrix
+        r:          (float) damping factor/restart probability
+        p0:         (numpy array) initial visiting probabilities, one column per
+                    seed set for several right hand sides
+        solver:     (str) "splu" (sparse LU), "gmres" or "power" (power iteration)
+        tol:        (float) relative tolerance of the iterative solvers
+        teleport:   (tuple) vectors (u, v) of the rank one term (see markov_matrix)
+        lu:         factorization of I-(1-r)M for splu (see factorize_rnd_walk),
+                    computed if not given
+
+    Returns:
+        x: (numpy array) visiting probabilities
+
+    """
+
+    def apply_markov(x):
+        if teleport is None:
+            return M @ x
+        u, v = teleport
+        return M @ x + np.multiply.outer(u, v @ x)
+
+    b = r * p0
+    if solver == "power":
+        # x = (1-r) M x + r p0 is a contraction, iterate to the fixed point
+        x = b.copy()
+        while True:
+            x_new = (1 - r) * apply_markov(x) + b
+            if np.all(np.abs(x_new - x).sum(axis=0) <= tol * np.abs(x_new).sum(axis=0)):
+                return x_new
+            x = x_new
+
+    if solver == "splu":
+        if lu is None:
+            lu = factorize_rnd_walk(M, r)
+        x = lu.solve(b)
+        if teleport is None:
+            return x
+        # (H1 - (1-r) u v^T)^-1 b with H1^-1 from the factorization
+        u, v = teleport
+        y = lu.solve(u)
+        return x + np.multiply.outer((1 - r) * y / (1 - (1 - r) * (v @ y)), v @ x)
+    H1 = (sp.identity(M.shape[0], dtype=M.dtype, format="csc") - (1 - r) * M).tocsc()
+    if solver == "gmres":
+        if teleport is not None:
+            H1 = linalg.LinearOperator(
+                M.shape, matvec=lambda x: x - (1 - r) * apply_markov(x), dtype=M.dtype
+            )
+        x = np.empty_like(b)
+        for j in range(b.shape[1] if b.ndim == 2 else 0):
+            x[:, j] = solve_gmres(H1, b[:, j], tol)
+        return x if b.ndim == 2 else solve_gmres(H1, b, tol)
+    raise ValueError(f"Unknown solver: {solver}")
+
+
+def factorize_rnd_walk(M, r):
+    """
+    Sparse LU factorization of I-(1-r)M.
+    """
+
+    H1 = (sp.identity(M.shape[0], dtype=M.dtype, format="csc") - (1 - r) * M).tocsc()
+    return linalg.splu(H1)
+
+
+# =============================================================================
+
+
+def factorization_key(A, nodes, r, alpha, symmetrical, precision="float64"):
+    """
+    Cache key of the RW operator factorization: the fingerprint of the network's
+    edge list, the restart parameter, the teleportation probability, the Markov
+    matrix type and the precision (only if not float64, keeping earlier keys).
+    """
+
+    edges = sp.triu(A, format="coo")
+    sources, targets = nodes[edges.row], nodes[edges.col]
+    sy = ["columwise", "symmetrical"]
+    key = f"{util.edge_fingerprint(sources, targets)}.{sy[symmetrical]}_r{r}_a{alpha}"
+    if precision != "float64":
+        key += f"_{precision}"
+    return key
+
+
+# =============================================================================
+
+
+def cached_factorization(cache_dir, key, M, r):
+    """
+    Load the factorization of I-(1-r)M with the given key from cache_dir, or
+    compute it and add it to the cache. The factors are stored as npz file with
+    L, U, perm_r and perm_c, a file is only visible once it is complete. Both a hit
+    and a miss solve with StoredLU, so the results do not depend on the cache state.
+    """
+
+    cached = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.exists(cached):
+        print(f"using cached factorization {cached}")
+        with np.load(cached) as factors:
+            return StoredLU(
+                sp.csr_matrix(
+                    (factors["L_data"], factors["L_indices"], factors["L_indptr"]),
+                    shape=tuple(factors["shape"]),
+                ),
+                sp.csr_matrix(
+                    (factors["U_data"], factors["U_indices"], factors["U_indptr"]),
+                    shape=tuple(factors["shape"]),
+                ),
+                factors["perm_r"],
+                factors["perm_c"],
+            )
+
+    lu = factorize_rnd_walk(M, r)
+    os.makedirs(cache_dir, exist_ok=True)
+    L, U = lu.L.tocsr(), lu.U.tocsr()
+    tmp = f"{cached}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(
+            f,
+            shape=np.array(L.shape),
+            L_data=L.data,
+            L_indices=L.indices,
+            L_indptr=L.indptr,
+            U_data=U.data,
+            U_indices=U.indices,
+            U_indptr=U.indptr,
+            perm_r=lu.perm_r,
+            perm_c=lu.perm_c,
+        )
+    os.replace(tmp, cached)
+    print(f"cached factorization {cached}")
+    return StoredLU(L, U, lu.perm_r, lu.perm_c)
+
+
+class StoredLU:
+    """
+    Solves with the factors of a SuperLU factorization Pr A Pc = L U (see
+    scipy.sparse.linalg.splu) loaded from the cache.
+    """
+
+    def __init__(self, L, U, perm_r, perm_c):
+        self.L = L
+        self.U = U
+        self.perm_r = perm_r
+        self.perm_c = perm_c
+
+    def solve(self, b):
+        y = np.empty_like(b, dtype=self.L.dtype)
+        y[self.perm_r] = b
+        y = linalg.spsolve_triangular(self.L, y, lower=True, unit_diagonal=True)
+        y = linalg.spsolve_triangular(self.U, y, lower=False)
+        return y[self.perm_c]
+
+
+# =============================================================================
+
+
+def solve_gmres(H1, b, tol):
+    x, info = linalg.gmres(H1, b, rtol=tol, atol=0.0)
+    if info != 0:
+        raise RuntimeError(f"GMRES did not converge (info={info})")
+    return x
+
+
+# =============================================================================
+
+
+def push_rnd_walk(A, r, p0, epsilon=1e-7, symmetrical=False):
+    """
+    Approximate the visiting probabilities r (I-(1-r)M)^-1 p0 by local pushes
+    (approximate personalized PageRank, Andersen, Chung and Lang 2006), so that only
+    the neighbourhood of the seeds is explored. The residual of a node is pushed, r
+    of it to its visiting probability and 1-r to its neighbours along M, as long as
+    it exceeds epsilon times the node's degree times the mass of p0. Nodes that are
+    never reached keep visiting probability 0.
+
+    The symmetric Markov matrix M_s = D^{-1/2} M D^{1/2} is handled by pushing
+    D^{1/2} p0 along the column-wise M and scaling the result with D^{-1/2}.
+
+    Parameters:
+        A:              (scipy csr matrix) adjacency matrix of the input graph
+        r:              (float) damping factor/restart probability
+        p0:             (numpy array) initial visiting probabilities, one column per
+                        seed set
+        epsilon:        (float) error tolerance per degree and seed mass
+        symmetrical:    (boolean) symmetric Markov matrix if True
+
+    Returns:
+        x: (numpy array) approximate visiting probabilities
+
+    """
+
+    A = sp.csr_matrix(A)
+    degree = np.asarray(A.sum(axis=1)).ravel()
+    if symmetrical:
+        p0 = np.sqrt(degree)[:, np.newaxis] * p0
+
+    x = np.zeros_like(p0)
+    for j in range(p0.shape[1]):
+        residual = p0[:, j].copy()
+        threshold = epsilon * residual.sum() * degree
+        queue = deque(np.flatnonzero(residual > threshold).tolist())
+        queued = residual > threshold
+        while queue:
+            node = queue.popleft()
+            queued[node] = False
+            mass = residual[node]
+            residual[node] = 0.0
+            x[node, j] += r * mass
+            start, end = A.indptr[node], A.indptr[node + 1]
+            neighbors = A.indices[start:end]
+            residual[neighbors] += (1 - r) * mass / degree[node] * A.data[start:end]
+            new = neighbors[
+                (residual[neighbors] > threshold[neighbors]) & ~queued[neighbors]
+            ]
+            queued[new] = True
+            queue.extend(new.tolist())
+
+    if symmetrical:
+        x = x / np.sqrt(degree)[:, np.newaxis]
+    return x
+
+
+# =============================================================================
+
+
+def create_mapping_index_entrezID(nodes):
     """
     Create the dictionaries to map genes' entrez IDs to indices and vice-versa.
 
     Parameter:
-        G: (networkx graph) input graph
+        nodes: (numpy array) sorted node names
 
     Returns:
         d_entz_idx: dictionary entrez ID to index
@@ -257,7 +679,7 @@ def create_mapping_index_entrezID(G):
 
     d_idx_entz = {}
     cc = 0
-    for entz in sorted(G.nodes()):
+    for entz in nodes.tolist():
         d_idx_entz[cc] = entz
         cc += 1
     d_entz_idx = dict((y, x) for x, y in d_idx_entz.items())
@@ -268,33 +690,34 @@ def create_mapping_index_entrezID(G):
 # =============================================================================
 
 
-def create_scaling_matrix(G):
+def node_degrees(A):
     """
-    Compute the diagonal matrix of the inverse degree of the nodes in graph G.
-
-    Parameter:
-        G: (networkx graph) input graph
-
-    Returns:
-        Dinvsqrt: diagonal matrix of the inverse degree of the nodes in graph G
-
+    Compute the degree of the nodes from the adjacency matrix A, self-loops count
+    twice as in networkx.
     """
 
-    n_nodes = G.number_of_nodes()
-    Dinvsqrt = np.zeros([n_nodes, n_nodes])  # basically dimensions of your graph
-    cc = 0
-    for node in sorted(G.nodes()):
-        kn = G.degree(node)
-        Dinvsqrt[cc, cc] = np.sqrt(1.0 / kn)
-        cc += 1
-
-    return Dinvsqrt
+    return np.asarray(A.sum(axis=1)).ravel() + A.diagonal()
 
 
 # =============================================================================
 
 
-def rwr(G, seed_genes, scaling, symmetrical, restart_parameter=0.8, alpha=1.0):
+def rwr(
+    A,
+    nodes,
+    seed_genes,
+    scaling,
+    symmetrical,
+    restart_parameter=0.8,
+    alpha=1.0,
+    solver="dense",
+    tol=1e-10,
+    outfile_name=None,
+    cache_dir=None,
+    epsilon=1e-7,
+    precision="float64",
+    report_deviation=False,
+):
     """
     Perform the random walk process (column-wise or symmetrical, with scaling or not),
     find the visiting probability to each node and determine the top-k ranked genes
@@ -303,7 +726,8 @@ def rwr(G, seed_genes, scaling, symmetrical, restart_parameter=0.8, alpha=1.0):
     and outputs the connected disease module.
 
     Parameters:
-        G:                  (networkx graph) input graph
+        A:                  (scipy sparse matrix) adjacency matrix of the input graph
+        nodes:              (numpy array) sorted node names, the order of A
         seed_genes:         (list) seed genes
         scaling:            (boolean) scale the visiting probabilities with the sqrt
                             of the degree of the corresponding node
@@ -311,6 +735,17 @@ def rwr(G, seed_genes, scaling, symmetrical, restart_parameter=0.8, alpha=1.0):
                             the column-wise normalized otherwise
         restart_parameter:  (float) damping factor/restart probability (default value 0.8)
         alpha:              (float) teleportation probability (default value 1)
+        solver:             (str) "dense" inverts the dense RW matrix, "splu", "gmres"
+                            and "power" solve the sparse system for p0 only, "push"
+                            approximates it locally around the seeds
+        tol:                (float) relative tolerance of the gmres and power solvers
+        outfile_name:       (str) output file (default from get_outfile_name)
+        cache_dir:          (str) directory caching the splu factorization per network,
+                            restart parameter, alpha and Markov matrix type
+        epsilon:            (float) error tolerance of the push solver
+        precision:          (str) "float64" or "float32" for the RW operator and solve
+        report_deviation:   (boolean) also solve in float64 and print the max deviation
+                            of the probabilities and the module ranking
 
     Returns:
         connected_disease_module:   list of genes containing the seed genes and the top-k
@@ -318,58 +753,278 @@ def rwr(G, seed_genes, scaling, symmetrical, restart_parameter=0.8, alpha=1.0):
                                     interactome
     """
 
-    d_entz_idx, d_idx_entz = create_mapping_index_entrezID(G)
+    if outfile_name is None:
+        outfile_name = get_outfile_name(scaling, symmetrical, restart_parameter)
+
+    return rwr_multi(
+        A,
+        nodes,
+        [seed_genes],
+        [outfile_name],
+        scaling,
+        symmetrical,
+        restart_parameter=restart_parameter,
+        alpha=alpha,
+        solver=solver,
+        tol=tol,
+        cache_dir=cache_dir,
+        epsilon=epsilon,
+        precision=precision,
+        report_deviation=report_deviation,
+    )[0]
+
+
+# =============================================================================
+
+
+def rwr_multi(
+    A,
+    nodes,
+    seed_gene_sets,
+    outfile_names,
+    scaling,
+    symmetrical,
+    restart_parameter=0.8,
+    alpha=1.0,
+    solver="dense",
+    tol=1e-10,
+    cache_dir=None,
+    epsilon=1e-7,
+    precision="float64",
+    report_deviation=False,
+):
+    """
+    Perform rwr for several seed gene sets at once. The RW operator is built (and
+    factorized) once and applied to all initial visiting probability vectors
+    together.
+
+    Parameters:
+        A:                  (scipy sparse matrix) adjacency matrix of the input graph
+        nodes:              (numpy array) sorted node names, the order of A
+        seed_gene_sets:     (list) seed genes of each run
+        outfile_names:      (list) output file of each run
+        others:             see rwr
+
+    Returns:
+        connected_disease_modules: list of the connected disease module of each run
+    """
 
-    n_nodes = G.number_of_nodes()
+    d_entz_idx, d_idx_entz = create_mapping_index_entrezID(nodes)
 
-    p0 = np.zeros(n_nodes)
+    n_nodes = A.shape[0]
+
+    p0 = np.zeros((n_nodes, len(seed_gene_sets)))
+    if scaling == 1:
+        degree = node_degrees(A)
 
     # select only the seed genes are on the PPI network
-    seed_genes_on_PPI = [gene for gene in seed_genes if gene in d_entz_idx.keys()]
+    seed_genes_on_PPI = [
+        [gene for gene in seed_genes if gene in d_entz_idx.keys()]
+        for seed_genes in seed_gene_sets
+    ]
 
-    # initialize (with optional scaling) of the visiting probability vector
-    for gene in seed_genes_on_PPI:
+    # initialize (with optional scaling) of the visiting probability vectors
+    for j, genes in enumerate(seed_genes_on_PPI):
+        idx = np.array([d_entz_idx[gene] for gene in genes], dtype=int)
         if scaling == 1:
-            k = G.degree(gene)
-            p0[d_entz_idx[gene]] = 1 * np.sqrt(k)
+            p0[idx, j] = np.sqrt(degree[idx])
         else:
-            p0[d_entz_idx[gene]] = 1.0
+            p0[idx, j] = 1.0
+
+    solve = dict(
+        scaling=scaling,
+        symmetrical=symmetrical,
+        restart_parameter=restart_parameter,
+        alpha=alpha,
+        solver=solver,
+        tol=tol,
+        cache_dir=cache_dir,
+        epsilon=epsilon,
+    )
+    pinf = visiting_probabilities(A, nodes, p0, precision=precision, **solve)
+
+    connected_disease_modules = [
+        write_connected_module(
+            A,
+            pinf[:, j],
+            seed_genes,
+            seed_genes_on_PPI[j],
+            nodes,
+            d_entz_idx,
+            outfile_name,
+        )
+        for j, (seed_genes, outfile_name) in enumerate(
+            zip(seed_gene_sets, outfile_names)
+        )
+    ]
 
-    # compute the colum-wise or symmetrical RW operator
-    if symmetrical == 1:
-        print("doing symmetrical")
-        W = symmetric_rnd_walk_matrix(G, r=restart_parameter)
-    else:
-        print("doing column-wise")
-        W = colwise_rnd_walk_matrix(G, r=restart_parameter, a=alpha)
+    if report_deviation and precision != "float64":
+        pinf64 = visiting_probabilities(A, nodes, p0, precision="float64", **solve)
+        for j, seed_genes in enumerate(seed_gene_sets):
+            report_precision_deviation(
+                A,
+                pinf[:, j],
+                pinf64[:, j],
+                seed_genes,
+                seed_genes_on_PPI[j],
+                connected_disease_modules[j],
+                nodes,
+                d_entz_idx,
+                outfile_names[j],
+                precision,
+            )
+
+    return connected_disease_modules
+
+
+# =============================================================================
+
+
+def visiting_probabilities(
+    A,
+    nodes,
+    p0,
+    scaling,
+    symmetrical,
+    restart_parameter=0.8,
+    alpha=1.0,
+    solver="dense",
+    tol=1e-10,
+    cache_dir=None,
+    epsilon=1e-7,
+    precision="float64",
+):
+    """
+    Apply the RW operator (see rwr) to the initial visiting probability vectors p0,
+    with optional scaling, in the given floating point precision.
+
+    Returns:
+        pinf: (numpy array) visiting probabilities, one column per seed set
+    """
 
-    # apply the RW operator on the visiting probability vector (with optional scaling)
+    dtype = np.dtype(precision)
+    p0 = p0.astype(dtype)
+    # relative tolerances below the resolution of the precision are never reached
+    tol = max(tol, 10 * np.finfo(dtype).eps)
     if scaling == 1:
-        Dinvsqrt = create_scaling_matrix(G)
-        pinf = np.array(np.dot(Dinvsqrt, np.dot(W, p0)))
+        dinvsqrt = np.sqrt(1.0 / node_degrees(A)).astype(dtype)
+
+    if solver == "push":
+        if alpha != 1.0 and symmetrical != 1:
+            raise ValueError(
+                "The push solver does not support teleportation (alpha < 1)"
+            )
+        print("approximating by local push")
+        pinf = push_rnd_walk(A, restart_parameter, p0, epsilon, symmetrical == 1)
+        if scaling == 1:
+            pinf = dinvsqrt[:, np.newaxis] * pinf
+    elif solver != "dense":
+        print(f"solving sparse system ({solver})")
+        M, teleport = markov_matrix(A, symmetrical == 1, a=alpha)
+        M = M.astype(dtype)
+        if teleport is not None:
+            teleport = tuple(v.astype(dtype) for v in teleport)
+        lu = None
+        if solver == "splu" and cache_dir is not None:
+            key = factorization_key(
+                A, nodes, restart_parameter, alpha, symmetrical, precision
+            )
+            lu = cached_factorization(cache_dir, key, M, restart_parameter)
+        pinf = solve_rnd_walk(
+            M,
+            restart_parameter,
+            p0,
+            solver=solver,
+            tol=tol,
+            teleport=teleport,
+            lu=lu,
+        )
+        del M
+        if scaling == 1:
+            pinf = dinvsqrt[:, np.newaxis] * pinf
     else:
-        pinf = np.dot(W, p0)
+        # compute the colum-wise or symmetrical RW operator
+        if symmetrical == 1:
+            print("doing symmetrical")
+            W = symmetric_rnd_walk_matrix(A, r=restart_parameter, dtype=dtype)
+        else:
+            print("doing column-wise")
+            W = colwise_rnd_walk_matrix(A, r=restart_parameter, a=alpha, dtype=dtype)
+
+        # apply the RW operator on the visiting probability vectors (with optional scaling)
+        if scaling == 1:
+            pinf = dinvsqrt[:, np.newaxis] * np.dot(W, p0)
+        else:
+            pinf = np.dot(W, p0)
+
+        del W
 
-    del W
+    return pinf
+
+
+# =============================================================================
+
+
+def report_precision_deviation(
+    A,
+    pinf,
+    pinf64,
+    seed_genes,
+    seed_genes_on_PPI,
+    connected_disease_module,
+    nodes,
+    d_entz_idx,
+    outfile_name,
+    precision,
+):
+    """
+    Print the max deviation of the visiting probabilities pinf from the float64
+    solution pinf64 (relative to the largest probability) and of the ranking: the
+    max shift in rank of the genes that the float64 ranking adds to the module, and
+    whether the module has the same genes.
+    """
 
-    # create dictionary of gene IDs and their corresponding visiting probability in sorted order
-    d_gene_pvis_sorted = {}
-    for p, x in sorted(zip(pinf, range(len(pinf))), reverse=True):
-        d_gene_pvis_sorted[d_idx_entz[x]] = p / len(seed_genes_on_PPI)
+    ranked = rank_without_seed_genes(pinf, nodes, seed_genes)
+    ranked64 = rank_without_seed_genes(pinf64, nodes, seed_genes)
+    module64 = grow_connected_module(A, d_entz_idx, seed_genes_on_PPI, ranked64)
+
+    position = dict((gene, i) for i, gene in enumerate(ranked))
+    added64 = ranked64[: len(module64) - len(seed_genes_on_PPI)]
+    rank_shift = max([abs(position[g] - i) for i, g in enumerate(added64)], default=0)
+    deviation = np.max(np.abs(pinf - pinf64)) / np.max(np.abs(pinf64))
+    same = set(connected_disease_module) == set(module64)
+    print(
+        f"{outfile_name}: {precision} vs float64 max relative probability deviation "
+        f"{deviation:.3g}, max rank shift of module genes {rank_shift}, module "
+        f"{'identical' if same else 'differs'}"
+    )
+
+
+# =============================================================================
+
+
+def write_connected_module(
+    A, pinf, seed_genes, seed_genes_on_PPI, nodes, d_entz_idx, outfile_name
+):
+    """
+    Rank the genes by their visiting probability, select the top ranked genes which
+    connect the seed genes and write them to outfile_name. nodes holds the gene IDs
+    in the order of pinf, d_entz_idx maps them to their index.
+
+    Returns:
+        connected_disease_module: list of the seed genes and the selected genes
+    """
+
+    # visiting probability of each gene
+    pvis = pinf / len(seed_genes_on_PPI)
 
     # obtain the ranking without seed genes
-    rwr_rank_without_seed_genes = [
-        g for g in list(d_gene_pvis_sorted.keys()) if g not in seed_genes
-    ]
+    rwr_rank_without_seed_genes = rank_without_seed_genes(pinf, nodes, seed_genes)
 
     # select the top ranked genes that lead to a connected component with the seed genes
-    i = 0
-    subgraph = nx.subgraph(G, seed_genes_on_PPI)
-    connected_disease_module = [g for g in seed_genes_on_PPI]
-    while not nx.is_connected(subgraph) and i < len(rwr_rank_without_seed_genes):
-        connected_disease_module.append(rwr_rank_without_seed_genes[i])
-        subgraph = nx.subgraph(G, connected_disease_module)
-        i += 1
+    connected_disease_module = grow_connected_module(
+        A, d_entz_idx, seed_genes_on_PPI, rwr_rank_without_seed_genes
+    )
 
     with open(outfile_name, "w") as fout:
         fout.write("\t".join(["#rank", "RWR_node", "visiting_probability"]))
@@ -378,7 +1033,7 @@ def rwr(G, seed_genes, scaling, symmetrical, restart_parameter=0.8, alpha=1.0):
         rank = 0
         for g in connected_disease_module:
             rank += 1
-            p = d_gene_pvis_sorted[g]
+            p = pvis[d_entz_idx[g]]
             fout.write("\t".join(map(str, ([rank, g, p]))))
             fout.write("\n")
             # fout.write(str(g) + '\t')
@@ -388,15 +1043,103 @@ def rwr(G, seed_genes, scaling, symmetrical, restart_parameter=0.8, alpha=1.0):
 
 # =============================================================================
 
-if __name__ == "__main__":
-    input_list = sys.argv
 
-    edgelist_file, seeds_file, scaling, sym, r, outfile_name = check_input_style(
-        input_list
-    )
+def rank_without_seed_genes(pinf, nodes, seed_genes):
+    """
+    Rank the genes that are not seed genes by decreasing visiting probability (ties
+    by decreasing index).
+    """
 
-    G, seed_genes = read_input(edgelist_file, seeds_file)
+    order = np.lexsort((np.arange(len(pinf)), pinf))[::-1]
+    is_seed = np.isin(nodes, list(seed_genes))
+    return nodes[order[~is_seed[order]]].tolist()
 
-    connected_disease_module = rwr(
-        G, seed_genes, scaling, sym, restart_parameter=r, alpha=1.0
+
+# =============================================================================
+
+
+def grow_connected_module(A, d_entz_idx, seed_genes_on_PPI, ranked_genes):
+    """
+    Add the ranked genes to the seed genes, in order, until the module induces a
+    connected subgraph of the graph with adjacency matrix A (or all genes are added).
+    The connected components of the module are tracked incrementally with a
+    union-find on the node indices (d_entz_idx), so each added gene only costs a look
+    at its row of A.
+
+    Returns:
+        connected_disease_module: list of the seed genes and the added genes
+    """
+
+    if len(seed_genes_on_PPI) == 0:
+        raise nx.NetworkXPointlessConcept(
+            "Connectivity is undefined for the null graph."
+        )
+
+    parent = {}
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    n_components = 0
+
+    def add(gene):
+        nonlocal n_components
+        node = d_entz_idx[gene]
+        parent[node] = node
+        n_components += 1
+        for neighbor in A.indices[A.indptr[node] : A.indptr[node + 1]].tolist():
+            if neighbor in parent:
+                root, neighbor_root = find(node), find(neighbor)
+                if root != neighbor_root:
+                    parent[root] = neighbor_root
+                    n_components -= 1
+
+    connected_disease_module = [g for g in seed_genes_on_PPI]
+    for g in connected_disease_module:
+        add(g)
+    i = 0
+    while n_components > 1 and i < len(ranked_genes):
+        connected_disease_module.append(ranked_genes[i])
+        add(ranked_genes[i])
+        i += 1
+
+    return connected_disease_module
+
+
+# =============================================================================
+
+if __name__ == "__main__":
+    args = parse_args()
+    outfile_name = get_outfile_name(args.scaling, args.symmetrical, args.r)
+
+    seeds_files = args.seeds_file.split(",")
+    A, nodes, seed_genes = read_input(args.network_file, seeds_files[0])
+    seed_gene_sets = [seed_genes] + [read_seeds(f) for f in seeds_files[1:]]
+
+    if len(seeds_files) > 1 or args.name_by_seeds:
+        outfile_names = [
+            f"{os.path.splitext(os.path.basename(f))[0]}.{outfile_name}"
+            for f in seeds_files
+        ]
+    else:
+        outfile_names = [outfile_name]
+
+    connected_disease_modules = rwr_multi(
+        A,
+        nodes,
+        seed_gene_sets,
+        outfile_names,
+        args.scaling,
+        args.symmetrical,
+        restart_parameter=args.r,
+        alpha=args.alpha,
+        solver=args.solver,
+        tol=args.tol,
+        cache_dir=args.cache_dir,
+        epsilon=args.epsilon,
+        precision=args.precision,
+        report_deviation=args.report_deviation,
     )
@@ -2,14 +2,14 @@
 
 """ Module evaluation (Self-consistency and robustness) """
 
-import networkx as nx
 import numpy as np
 import matplotlib.pyplot as plt
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
 import sys
 import graph_tool.all as gt
 import csv
 import argparse
-import pyintergraph
 import logging
 
 logger = logging.getLogger()
@@ -53,25 +53,45 @@ def read_input(args):
             l_seeds.append(seed_gene)
         perturbed_seeds.append(l_seeds)
 
-    # read the PPI network and create a NetworkX graph
-    G_ppi = pyintergraph.gt2nx(gt.load_graph(args.network), labelname="name")
-
-    # G_connected_ppi = G_ppi.subgraph(
-    #    max(nx.connected_components(G_ppi), key=len)
-    # )
+    # read the PPI network as adjacency matrix
+    g_ppi = gt.load_graph(args.network)
+    nodes_ppi = [g_ppi.vp["name"][v] for v in g_ppi.iter_vertices()]
+    A_ppi = adjacency_matrix(len(nodes_ppi), g_ppi.get_edges())
 
     return (
         reference_candidates,
         original_seeds,
         lists_candidates,
         perturbed_seeds,
-        G_ppi,
+        (A_ppi, nodes_ppi),
     )
 
 
 # =============================================================================
 
 
+def adjacency_matrix(n_nodes, edges):
+    """
+    Build the symmetric 0/1 adjacency matrix of an undirected simple graph (parallel
+    edges merged, a self-loop is a 1 on the diagonal) from an edge array with rows
+    (source, target) of vertex indices.
+    """
+
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    A = sp.csr_matrix(
+        (
+            np.ones(2 * len(edges), dtype=np.int64),
+            (np.r_[edges[:, 0], edges[:, 1]], np.r_[edges[:, 1], edges[:, 0]]),
+        ),
+        shape=(n_nodes, n_nodes),
+    )
+    A.data[:] = 1
+    return A
+
+
+# =============================================================================
+
+
 def write_output_tsv_file(data, headers, file_name):
 
     if len(data[0]) == (len(headers) + 1):
@@ -172,7 +192,83 @@ def jaccard_index(lists_candidates, reference_candidates):
 # =============================================================================
 
 
-def topological_measures(reference_candidates, G, lists_candidates):
+def module_measures(A, masks):
+    """
+    Compute the topological measures of several modules on the network with
+    adjacency matrix A in one pass over their incidence with the edges. The modules
+    are given as boolean node masks (one row per module). Parallel edges count once,
+    a self-loop is an edge of its node and adds two to its degree.
+
+    Return:
+        lcc:            size of the largest connected component of each module
+        connected:      number of nodes with an edge inside their module
+        interedges:     number of edges inside each module
+        degree_sums:    sum over the degree of the nodes of each module
+        modularity:     modularity of the partition module VS the rest of the network
+    """
+
+    n_modules = masks.shape[0]
+    degree = np.asarray(A.sum(axis=1)).ravel() + A.diagonal()
+    loops = A.diagonal()
+
+    # one entry per (module, node) pair, numbered consecutively module by module
+    member_module, member_node = np.nonzero(masks)
+    position = np.zeros(masks.shape, dtype=np.int64)
+    position[member_module, member_node] = np.arange(len(member_node))
+
+    # edges of the members that stay inside their module
+    rows = A[member_node]
+    member = np.repeat(np.arange(len(member_node)), np.diff(rows.indptr))
+    inside = masks[member_module[member], rows.indices]
+    member, neighbor = member[inside], rows.indices[inside]
+    internal_degree = np.bincount(member, minlength=len(member_node))
+
+    # the block diagonal graph of all modules gives all their components at once
+    block = sp.csr_matrix(
+        (
+            np.ones(len(member), dtype=np.int8),
+            (member, position[member_module[member], neighbor]),
+        ),
+        shape=(len(member_node), len(member_node)),
+    )
+    _, component = connected_components(block, directed=False)
+    component_size = np.bincount(component)
+    lcc = np.zeros(n_modules, dtype=np.int64)
+    np.maximum.at(lcc, member_module, component_size[component])
+
+    connected = np.bincount(
+        member_module, weights=internal_degree > 0, minlength=n_modules
+    ).astype(np.int64)
+    interedges = (
+        np.bincount(
+            member_module,
+            weights=internal_degree + loops[member_node],
+            minlength=n_modules,
+        ).astype(np.int64)
+        // 2
+    )
+    degree_sums = np.bincount(
+        member_module, weights=degree[member_node], minlength=n_modules
+    ).astype(np.int64)
+
+    # two communities: L_c / m - (d_c / 2m)^2 summed over the module and the rest,
+    # evaluated as networkx.community.modularity does
+    deg_sum = int(degree.sum())
+    m = deg_sum / 2
+    norm = 1 / deg_sum**2
+    outer_edges = deg_sum // 2 - degree_sums + interedges
+    outer_degree_sums = deg_sum - degree_sums
+    modularity = (interedges / m - degree_sums * degree_sums * norm) + (
+        outer_edges / m - outer_degree_sums * outer_degree_sums * norm
+    )
+
+    return lcc, connected, interedges, degree_sums, modularity
+
+
+# =============================================================================
+
+
+def topological_measures(reference_candidates, network, lists_candidates):
     """
     Robustness measure: Compute four topological measures to compare the reference module with the
     permutated modules:
@@ -182,6 +278,9 @@ def topological_measures(reference_candidates, G, lists_candidates):
         (sum over the degree of all nodes)
         - the modularity of the module (module VS the rest of the network)
 
+    The reference and all permuted modules are evaluated together as node masks on
+    the network's adjacency matrix (see module_measures).
+
     Return:
         l_results: list of results for the 4 topological measures for all permutations
         l_mu:      list of the 4 averaged topological measures (average over permutations)
@@ -189,35 +288,37 @@ def topological_measures(reference_candidates, G, lists_candidates):
         l_zscore:  list of the 4 z-scores for the topological measures
     """
 
-    candidate_network = G.subgraph(reference_candidates)
-    nodes_ppi = list(G.nodes())
-    n_candidates = len(reference_candidates)
-    nodes_ppi_wo_candidate = [n for n in nodes_ppi if n not in reference_candidates]
+    A, nodes_ppi = network
+    node_index = dict((name, i) for i, name in enumerate(nodes_ppi))
+
+    # map each module to a boolean node mask, the reference module first
+    modules = [reference_candidates] + lists_candidates
+    masks = np.zeros((len(modules), len(nodes_ppi)), dtype=bool)
+    for k, module in enumerate(modules):
+        masks[k, [node_index[n] for n in module]] = True
+
+    lcc, connected, interedges, degree_sums, modularities = (
+        values.tolist() for values in module_measures(A, masks)
+    )
 
     # size of the largest connected component (LCC)
-    lcc_size = len(max(nx.connected_components(candidate_network), key=len))
-    l_random_lcc = []
+    lcc_size = lcc[0]
 
     # number of connected genes (takes also into account the case of multiple connected components)
-    interconnected_genes = n_candidates - len(list(nx.isolates(candidate_network)))
-    l_interconnected_genes = []
+    interconnected_genes = connected[0]
 
     # normalized number of interedges
-    interedges = candidate_network.number_of_edges()
-
-    n_possible_connections = (
-        sum([G.degree(s) for s in reference_candidates]) - interedges
-    )
-    edgibility = interedges / n_possible_connections
-    l_random_edgibility = []
+    edgibility = interedges[0] / (degree_sums[0] - interedges[0])
 
     # modularity (computed as the candidates VS the whole network)
-    modularity = nx.community.modularity(
-        G, [reference_candidates, nodes_ppi_wo_candidate]
-    )
+    modularity = modularities[0]
+
+    l_random_lcc = []
+    l_interconnected_genes = []
+    l_random_edgibility = []
     l_random_modularity = []
 
-    for l in lists_candidates:
+    for k, l in enumerate(lists_candidates, start=1):
 
         # check if the list is empty
         if not l:
@@ -228,27 +329,11 @@ def topological_measures(reference_candidates, G, lists_candidates):
             logger.warning("Empty list of permuted candidates")
             continue
 
-        G_sub = nx.subgraph(G, l)
-        n_candidates_perturbed = G_sub.number_of_nodes()
-
-        # LCC
-        lcc_size_rd = len(max(nx.connected_components(G_sub), key=len))
-        l_random_lcc.append(lcc_size_rd)
-
-        # number of connected genes
-        interconnected_nodes_rd = n_candidates_perturbed - len(list(nx.isolates(G_sub)))
-        l_interconnected_genes.append(interconnected_nodes_rd)
-
-        # normalized number of interedges
-        interedges_rd = G_sub.number_of_edges()
-        n_possible_connections_rd = sum([G.degree(s) for s in l]) - interedges_rd
-        edgibility_rd = interedges_rd / n_possible_connections_rd
+        l_random_lcc.append(lcc[k])
+        l_interconnected_genes.append(connected[k])
+        edgibility_rd = interedges[k] / (degree_sums[k] - interedges[k])
         l_random_edgibility.append(round(edgibility_rd, 4))
-
-        # modularity
-        nodes_ppi_wo_seeds_rd = [n for n in nodes_ppi if n not in l]
-        modularity_rd = nx.community.modularity(G, [l, nodes_ppi_wo_seeds_rd])
-        l_random_modularity.append(round(modularity_rd, 4))
+        l_random_modularity.append(round(modularities[k], 4))
 
     mu_lcc = np.mean(l_random_lcc)
     std_lcc = np.std(l_random_lcc)
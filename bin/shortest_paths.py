@@ -1,22 +1,313 @@
 #! /usr/bin/env python
 
+import argparse
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
-import pickle
-import sys
+import shutil
 import networkx as nx
+import numpy as np
+import pandas as pd
 import graph_tool.all as gt
 import pyintergraph
+import util
 
+# Rows per block when --threads > 1 is given without --block-size
+DEFAULT_BLOCK_SIZE = 256
 
-def get_shortest_paths(graph, dump_file):
+
+def get_shortest_paths(graph, dump_file, sources=None):
+    """
+    Write the shortest path lengths of the graph as a uint8 distance matrix.
+    Rows and columns follow the sorted node names. If sources is given, only the
+    rows of the sources present in the graph are computed (sources x all nodes).
+    Returns True if the matrix was computed, False if dump_file already existed.
+    """
     if not os.path.exists(dump_file):
-        lengths = dict(nx.shortest_path_length(graph))
-        if dump_file is not None:
-            logging.warning("Pickled file not found: {}".format(dump_file))
-            pickle.dump(lengths, open(dump_file, "wb"))
-    else:
+        logging.warning("Distance file not found: {}".format(dump_file))
+        nodes = sorted(graph.nodes())
+        node_to_index = {node: i for i, node in enumerate(nodes)}
+        if sources is None:
+            rows = nodes
+            lengths_iter = nx.shortest_path_length(graph)
+        else:
+            rows = sorted(set(sources) & set(nodes))
+            lengths_iter = (
+                (source, nx.single_source_shortest_path_length(graph, source))
+                for source in rows
+            )
+        row_to_index = {node: i for i, node in enumerate(rows)}
+        distances = util.create_distance_matrix(
+            f"{dump_file}.tmp", rows, None if sources is None else nodes
+        )
+        for source, lengths in lengths_iter:
+            row = distances[row_to_index[source]]
+            row[:] = util.UNREACHABLE_DISTANCE
+            for target, length in lengths.items():
+                if length >= util.UNREACHABLE_DISTANCE:
+                    raise ValueError(
+                        f"Distance {length} between {source} and {target} does not fit into uint8"
+                    )
+                row[node_to_index[target]] = length
+        finish_distance_matrix(distances, dump_file)
+        return True
+    logging.info("Using existing dump file: {}".format(dump_file))
+    return False
+
+
+def get_shortest_paths_gt(g, dump_file, sources=None):
+    """
+    Same as get_shortest_paths, but runs graph-tool's BFS directly on the graph-tool graph.
+    Each source row is computed with a single-source BFS and written straight into the
+    memory-mapped matrix, so only one row is held in memory (graph-tool's all-pairs
+    BFS would materialise the full matrix as int32 first). For parallel computation,
+    see get_shortest_paths_blocks.
+    """
+    if not os.path.exists(dump_file):
+        logging.warning("Distance file not found: {}".format(dump_file))
+        names, order = sorted_vertex_order(g)
+        rows = order if sources is None else source_vertices(names, order, sources)
+        distances = util.create_distance_matrix(
+            f"{dump_file}.tmp",
+            names[rows].tolist(),
+            None if sources is None else names[order].tolist(),
+        )
+        for i, v in enumerate(rows):
+            distances[i] = bfs_row(g, v, order, names)
+        finish_distance_matrix(distances, dump_file)
+        return True
+    logging.info("Using existing dump file: {}".format(dump_file))
+    return False
+
+
+def get_shortest_paths_blocks(
+    network_file,
+    dump_file,
+    block_size,
+    blocks_dir=None,
+    block=None,
+    threads=1,
+    sources=None,
+    g=None,
+):
+    """
+    Chunked variant of get_shortest_paths_gt. The sorted source vertices are split into
+    row blocks of block_size, each block is computed independently (in a process pool of
+    size threads) and checkpointed as .npy file in blocks_dir. Blocks that already exist
+    are not recomputed, so a restarted job continues where it stopped. If block is given,
+    only that block is computed (e.g. as separate task), otherwise all blocks are merged
+    into the final distance matrix. Returns True if the final matrix was written.
+    """
+    if os.path.exists(dump_file):
         logging.info("Using existing dump file: {}".format(dump_file))
+        return False
+    blocks_dir = blocks_dir or f"{dump_file}.blocks"
+    if g is None:
+        g = parse_network_gt(network_file)
+    names, order = sorted_vertex_order(g)
+    rows = order if sources is None else source_vertices(names, order, sources)
+    starts = range(0, len(rows), block_size)
+    edges = g.get_edges()
+    check_blocks_dir(
+        blocks_dir,
+        names[rows],
+        names[order],
+        block_size,
+        util.edge_fingerprint(names[edges[:, 0]], names[edges[:, 1]]),
+    )
+
+    if block is not None:
+        if block >= len(starts):
+            raise ValueError(
+                f"Block {block} out of range, there are {len(starts)} blocks"
+            )
+        starts = [starts[block]]
+    pending = [
+        start for start in starts if not os.path.exists(block_path(blocks_dir, start))
+    ]
+    logging.info(f"{len(starts) - len(pending)}/{len(starts)} blocks already computed")
+
+    if threads > 1 and len(pending) > 1:
+        with multiprocessing.Pool(
+            threads, initializer=init_block_worker, initargs=(network_file, rows)
+        ) as pool:
+            for start in pool.imap_unordered(
+                compute_block, [(start, block_size, blocks_dir) for start in pending]
+            ):
+                logging.info(f"Computed block starting at row {start}")
+    else:
+        _block_worker["graph"] = g
+        _block_worker["rows"] = rows
+        for start in pending:
+            compute_block((start, block_size, blocks_dir))
+            logging.info(f"Computed block starting at row {start}")
+
+    if block is not None:
+        return False
+
+    distances = util.create_distance_matrix(
+        f"{dump_file}.tmp",
+        names[rows].tolist(),
+        None if sources is None else names[order].tolist(),
+    )
+    for start in starts:
+        block_rows = np.load(block_path(blocks_dir, start), mmap_mode="r")
+        distances[start : start + len(block_rows)] = block_rows
+    finish_distance_matrix(distances, dump_file)
+    for start in starts:
+        os.remove(block_path(blocks_dir, start))
+    return True
+
+
+_block_worker = {}
+
+
+def init_block_worker(network_file, rows):
+    gt.openmp_set_num_threads(1)
+    _block_worker["graph"] = parse_network_gt(network_file)
+    _block_worker["rows"] = rows
+
+
+def compute_block(task):
+    """
+    Compute the distance rows of one block with single-source BFS and write them atomically.
+    """
+    start, block_size, blocks_dir = task
+    g = _block_worker["graph"]
+    names, order = sorted_vertex_order(g)
+    sources = _block_worker["rows"][start : start + block_size]
+    block_rows = np.empty((len(sources), len(order)), dtype=np.uint8)
+    for i, v in enumerate(sources):
+        block_rows[i] = bfs_row(g, v, order, names)
+    path = block_path(blocks_dir, start)
+    with open(f"{path}.tmp", "wb") as file:
+        np.save(file, block_rows)
+    os.replace(f"{path}.tmp", path)
+    return start
+
+
+def finish_distance_matrix(distances, dump_file):
+    """
+    Flush the distance matrix written to <dump_file>.tmp and move it to dump_file. An
+    existing dump_file is therefore always complete, an interrupted run leaves only
+    the .tmp file, which is overwritten by the next run.
+    """
+    distances.flush()
+    os.replace(f"{dump_file}.tmp", dump_file)
+
+
+def cache_key(names, edge_sources, edge_targets, sources=None):
+    """
+    Cache key of a distance matrix: the fingerprint of the sorted edge list, extended by a
+    hash of the source rows if the matrix is restricted to sources.
+    """
+    key = util.edge_fingerprint(edge_sources, edge_targets)
+    if sources is not None:
+        rows = sorted(set(sources) & set(names))
+        key += "." + hashlib.sha256("\n".join(rows).encode()).hexdigest()[:16]
+    return key
+
+
+def fetch_cached(cache_dir, key, dump_file):
+    """
+    Copy the cached distance matrix with the given key to dump_file. Returns False on a cache miss.
+    """
+    cached = os.path.join(cache_dir, f"{key}.spd")
+    if not os.path.exists(cached):
+        logging.info(f"No cached distances for {key} in {cache_dir}")
+        return False
+    logging.info(f"Using cached distances: {cached}")
+    link_or_copy(cached, dump_file)
+    return True
+
+
+def store_cached(cache_dir, key, dump_file):
+    """
+    Add dump_file to the cache, the file is only visible once it is complete.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = os.path.join(cache_dir, f"{key}.spd")
+    link_or_copy(dump_file, f"{cached}.{os.getpid()}.tmp")
+    os.replace(f"{cached}.{os.getpid()}.tmp", cached)
+    logging.info(f"Cached distances: {cached}")
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def bfs_row(g, v, order, names):
+    """
+    Distances from vertex v to all vertices, ordered by order.
+    """
+    return check_row(gt.shortest_distance(g, source=g.vertex(v)).a[order], names[v])
+
+
+def check_row(row, name):
+    if row.max() >= util.UNREACHABLE_DISTANCE:
+        raise ValueError(
+            f"Distances from {name} do not fit into uint8, is the graph connected?"
+        )
+    return row
+
+
+def block_path(blocks_dir, start):
+    return os.path.join(blocks_dir, f"block_{start:09d}.npy")
+
+
+def check_blocks_dir(blocks_dir, rows, cols, block_size, edges):
+    """
+    Make sure the checkpointed blocks in blocks_dir were computed for the same network
+    (edges is its util.edge_fingerprint), sources, and block size. The manifest is
+    written atomically, as tasks computing single blocks may share blocks_dir.
+    """
+    manifest = {
+        "rows": hashlib.sha256("\n".join(rows).encode()).hexdigest(),
+        "cols": hashlib.sha256("\n".join(cols).encode()).hexdigest(),
+        "edges": edges,
+        "block_size": block_size,
+    }
+    manifest_file = os.path.join(blocks_dir, "manifest.json")
+    os.makedirs(blocks_dir, exist_ok=True)
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as file:
+            if json.load(file) != manifest:
+                raise ValueError(
+                    f"{blocks_dir} contains blocks of a different network, sources, or block size"
+                )
+    else:
+        tmp = f"{manifest_file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(manifest, file)
+        os.replace(tmp, manifest_file)
+
+
+def sorted_vertex_order(g):
+    """
+    Returns the vertex names and the vertex indices sorted by name.
+    """
+    names = np.array([g.vp["name"][v] for v in g.iter_vertices()])
+    return names, np.argsort(names, kind="stable")
+
+
+def source_vertices(names, order, sources):
+    """
+    Returns the vertex indices of the sources present in the graph, sorted by name.
+    """
+    return order[np.isin(names[order], list(set(sources)))]
+
+
+def parse_sources(sources_file, source_column):
+    """
+    Reads the source nodes (e.g. drug targets) from a column of a tab-separated file.
+    """
+    data = pd.read_csv(sources_file, sep="\t")
+    return [str(x) for x in data[source_column]]
 
 
 def parse_network(network_file):  # , id_mapping_file=None
@@ -31,17 +322,136 @@ def parse_network(network_file):  # , id_mapping_file=None
     return network
 
 
-def main():
+def parse_network_gt(network_file):
+    """
+    Load the largest connected component of the network as a compacted graph-tool graph.
+    """
+    g = gt.load_graph(network_file)
+    g.set_vertex_filter(gt.label_largest_component(g))
+    return gt.Graph(g, prune=True)
+
+
+def parse_args(argv=None):
+    """Define and immediately parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Compute shortest path lengths on the largest connected component.",
+        epilog="Example: python shortest_paths.py network.gt network.shortest_paths.spd",
+    )
+    parser.add_argument(
+        "network_file",
+        help="The network in gt format.",
+        type=str,
+    )
+    parser.add_argument(
+        "dump_file",
+        help="The output distance matrix file (default shortest_paths.spd).",
+        type=str,
+        nargs="?",
+        default="shortest_paths.spd",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help="The library computing the distances (default graph-tool).",
+        choices=("graph-tool", "networkx"),
+        default="graph-tool",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of worker processes of the graph-tool engine (default 1). With more than "
+        f"one, the matrix is computed in blocks (of {DEFAULT_BLOCK_SIZE} rows unless "
+        "--block-size is given).",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-b",
+        "--block-size",
+        help="Compute the matrix in checkpointed blocks of this many source rows (graph-tool engine only). "
+        "The blocks are kept on disk until they are merged, which needs up to the size of the matrix.",
+        type=int,
+    )
+    parser.add_argument(
+        "--blocks-dir",
+        help="Directory for the checkpointed blocks (default <dump_file>.blocks).",
+        type=str,
+    )
+    parser.add_argument(
+        "--block",
+        help="Only compute the block with this index and skip merging.",
+        type=int,
+    )
+    parser.add_argument(
+        "-s",
+        "--sources",
+        help="Tab-separated file (e.g. drug to target table). If given, only distances from these nodes are computed.",
+        type=str,
+    )
+    parser.add_argument(
+        "--source-column",
+        help="Column of the sources file holding the node names (default targetDomainId).",
+        type=str,
+        default="targetDomainId",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache-dir",
+        help="Directory of cached distance matrices, keyed by the fingerprint of the network's edge list.",
+        type=str,
+    )
+    args = parser.parse_args(argv)
+    if args.block is not None and args.block_size is None:
+        parser.error("--block requires --block-size")
+    if args.block_size is not None and args.engine != "graph-tool":
+        parser.error("--block-size is only supported by the graph-tool engine")
+    return args
+
+
+def main(argv=None):
     logging.basicConfig(filename="shortest_paths.log", level=logging.DEBUG)  # INFO
 
-    if len(sys.argv) < 2:
-        print("Usage: python shortest_paths.py <network_data> [<dump_file>]")
-        sys.exit(1)
+    args = parse_args(argv)
+    sources = None
+    if args.sources is not None:
+        sources = parse_sources(args.sources, args.source_column)
+    if args.engine == "networkx":
+        network = parse_network(args.network_file)
+        names = list(network.nodes())
+        edge_sources, edge_targets = zip(*network.edges())
+    else:
+        network = parse_network_gt(args.network_file)
+        names = sorted_vertex_order(network)[0]
+        edges = network.get_edges()
+        edge_sources, edge_targets = names[edges[:, 0]], names[edges[:, 1]]
+
+    use_cache = args.cache_dir is not None and args.block is None
+    if use_cache:
+        key = cache_key(names, edge_sources, edge_targets, sources)
+        if fetch_cached(args.cache_dir, key, args.dump_file):
+            return
+
+    if args.block_size is None and args.engine == "graph-tool" and args.threads > 1:
+        args.block_size = DEFAULT_BLOCK_SIZE
+    if args.block_size is not None:
+        computed = get_shortest_paths_blocks(
+            args.network_file,
+            args.dump_file,
+            args.block_size,
+            blocks_dir=args.blocks_dir,
+            block=args.block,
+            threads=args.threads,
+            sources=sources,
+            g=network,
+        )
+    elif args.engine == "networkx":
+        computed = get_shortest_paths(network, args.dump_file, sources=sources)
+    else:
+        computed = get_shortest_paths_gt(network, args.dump_file, sources=sources)
 
-    network_file = sys.argv[1]
-    network = parse_network(network_file)
-    dump_file = sys.argv[2] if len(sys.argv) > 2 else "shortest_paths.pkl"
-    get_shortest_paths(network, dump_file)
+    # only cache matrices computed here, an existing dump file is not verified
+    if use_cache and computed:
+        store_cached(args.cache_dir, key, args.dump_file)
 
 
 if __name__ == "__main__":
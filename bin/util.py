@@ -1,4 +1,8 @@
+import hashlib
+import json
+import struct
 import graph_tool.all as gt
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
@@ -82,3 +86,79 @@ def ep2df(g):
     df = pd.DataFrame(data)
     df.set_index(["source", "target"], inplace=True)
     return df
+
+
+DISTANCE_MAGIC = b"MDSPDIST"
+UNREACHABLE_DISTANCE = 255
+
+
+def create_distance_matrix(path, rows, cols=None, **metadata):
+    """
+    Create an on-disk uint8 distance matrix and return it as a writable numpy.memmap.
+
+    The file starts with a JSON header holding the sorted row and column names
+    (cols=None means the matrix is square over rows), followed by the raw matrix.
+    Additional keyword arguments are stored in the header as metadata.
+    """
+    shape = (len(rows), len(rows) if cols is None else len(cols))
+    header = dict(metadata)
+    header.update(
+        {
+            "dtype": "uint8",
+            "shape": shape,
+            "rows": list(rows),
+            "cols": None if cols is None else list(cols),
+        }
+    )
+    header = json.dumps(header).encode()
+    header += b" " * (-(len(DISTANCE_MAGIC) + 8 + len(header)) % 64)  # align matrix
+    offset = len(DISTANCE_MAGIC) + 8 + len(header)
+    with open(path, "wb") as file:
+        file.write(DISTANCE_MAGIC)
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        file.truncate(offset + shape[0] * shape[1])
+    return np.memmap(path, dtype=np.uint8, mode="r+", offset=offset, shape=shape)
+
+
+def read_distance_header(path):
+    """
+    Read the header of a distance matrix file. Returns the header dict and the byte offset of the matrix.
+    """
+    with open(path, "rb") as file:
+        if file.read(len(DISTANCE_MAGIC)) != DISTANCE_MAGIC:
+            raise ValueError(f"{path} is not a distance matrix file")
+        (length,) = struct.unpack("<Q", file.read(8))
+        header = json.loads(file.read(length))
+    return header, len(DISTANCE_MAGIC) + 8 + length
+
+
+def load_distance_matrix(path, mode="r"):
+    """
+    Open a distance matrix file as numpy.memmap. Returns the matrix, the row names and the column names.
+    """
+    header, offset = read_distance_header(path)
+    rows = header["rows"]
+    cols = rows if header["cols"] is None else header["cols"]
+    matrix = np.memmap(
+        path,
+        dtype=header["dtype"],
+        mode=mode,
+        offset=offset,
+        shape=tuple(header["shape"]),
+    )
+    return matrix, rows, cols
+
+
+def edge_fingerprint(sources, targets):
+    """
+    SHA-256 fingerprint of an undirected edge list given as two arrays of node names.
+    The fingerprint does not depend on edge order, edge direction or duplicate edges.
+    """
+    sources = np.asarray(sources, dtype=str)
+    targets = np.asarray(targets, dtype=str)
+    swap = sources > targets
+    low = np.where(swap, targets, sources)
+    high = np.where(swap, sources, targets)
+    edges = np.unique(np.char.add(np.char.add(low, "\t"), high))
+    return hashlib.sha256("\n".join(edges).encode()).hexdigest()
@@ -1,6 +1,6 @@
 process PROXIMITY {
     tag "$meta.id"
-    label 'process_single'
+    label 'process_low'
 
     input:
     path network
@@ -10,9 +10,13 @@ process PROXIMITY {
 
     output:
     path("${meta.id}.proximity.tsv"), emit: proxout
+    path("${meta.id}.proximity.parquet"), emit: parquet, optional: true
+    path("${meta.id}.proximity_matrix.tsv"), emit: matrix, optional: true
     path "versions.yml", emit: versions
 
     script:
+    def args = task.ext.args ?: ''         // Additional lines for the config file (e.g. output_formats = tsv,parquet)
+    def matrix = meta.grouped ? "matrix_file = ${meta.id}.proximity_matrix.tsv" : ''
     """
     # Create a config file.
     cat <<EOT > proximity_config.txt
@@ -28,6 +32,9 @@ process PROXIMITY {
     shortest_paths = ${shortest_paths}
     id_mapping_file = None
     output_file = ${meta.id}.proximity.tsv
+    n_jobs = ${task.cpus}
+    ${matrix}
+    ${args}
     EOT
 
     # Run proximity.
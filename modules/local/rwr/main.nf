@@ -4,7 +4,7 @@ process RWR {
     label 'process_low'
 
     input:
-    tuple val(meta), path(seeds), path (network)    // Input files
+    tuple val(meta), path(seeds), path (network)    // Input files (several seed files are solved together)
     val scaling                                     // RWR specific parameter "scaling"
     val symmetrical                                 // RWR spefific parameter "symmetrical"
     val r                                           // RWR specific parameter "r"
@@ -17,17 +17,23 @@ process RWR {
     task.ext.when == null || task.ext.when
 
     script:
+    def args = task.ext.args ?: ''          // Optional solver arguments, e.g. --solver power --tol 1e-8
+    def seeds_files = [seeds].flatten().join(',')
+    def name_by_seeds = meta.batch ? '--name-by-seeds' : ''
     """
     rwr.py \\
         $network \\
-        $seeds \\
+        $seeds_files \\
         $scaling \\
         $symmetrical \\
-        $r
+        $r \\
+        $name_by_seeds \\
+        $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
         python: \$(python --version | sed 's/Python //g')
+        graph-tool: \$(python -c "import graph_tool; print(graph_tool.__version__)")
     END_VERSIONS
     """
 }
@@ -4,19 +4,26 @@ process SHORTEST_PATHS {
 
     input:
     tuple val(meta), path (network)
+    path drug_to_target
+    val targets_only                                // Only compute distances from drug targets
 
     output:
-    tuple val(meta), path (network), path ("${meta.id}.shortest_paths.pkl"), emit: sp
+    tuple val(meta), path (network), path ("${meta.id}.shortest_paths.spd"), emit: sp
     path "versions.yml", emit: versions
 
     script:
+    def args = task.ext.args ?: ''
+    def sources = targets_only ? "--sources ${drug_to_target} --source-column targetDomainId" : ''
     """
-    shortest_paths.py ${network} "${meta.id}.shortest_paths.pkl"
+    shortest_paths.py ${network} "${meta.id}.shortest_paths.spd" --threads ${task.cpus} ${sources} ${args}
 
     cat <<-END_VERSIONS > versions.yml
         "${task.process}":
             python: \$(python --version | sed 's/Python //g')
+            graph-tool: \$(python -c "import graph_tool; print(graph_tool.__version__)")
             networkx: \$(python -c "import networkx; print(networkx.__version__)")
+            numpy: \$(python -c "import numpy; print(numpy.__version__)")
+            pandas: \$(python -c "import pandas; print(pandas.__version__)")
     END_VERSIONS
     """
 }
@@ -8,6 +8,8 @@ workflow GT_PROXIMITY {
     ch_modules
     ch_shortest_paths
     drug_to_target
+    targets_only                            // Only compute shortest paths from drug targets
+    group_modules                           // Score all modules of a network in one proximity run
 
     main:
 
@@ -24,13 +26,22 @@ workflow GT_PROXIMITY {
 
     // Compute shortest paths if they have not been computed
     // channel: [ val(meta[id,network_id]), path(network), path(sp) ]
-    SHORTEST_PATHS(ch_shortest_paths.no_sp.map{meta, network, sp -> [meta, network]})
+    SHORTEST_PATHS(ch_shortest_paths.no_sp.map{meta, network, sp -> [meta, network]}, drug_to_target, targets_only)
     ch_versions = ch_versions.mix(SHORTEST_PATHS.out.versions.first())
 
     // Combine the computed shortest paths with the input shortest paths
     // channel: [ val(meta[id,network_id]), path(network), path(sp) ]
     ch_shortest_paths = ch_shortest_paths.sp.mix(SHORTEST_PATHS.out.sp)
 
+    // Optionally group the modules by network
+    // channel: [ val(meta[id,network_id,grouped]), [ path(module) ] ]
+    if (group_modules) {
+        ch_modules = ch_modules
+            .map{meta, module -> [meta.network_id, module]}
+            .groupTuple()
+            .map{network_id, modules -> [[id: network_id, network_id: network_id, grouped: true], modules]}
+    }
+
     //Prepare proximity input
     // channel: [ val(meta[id,module_id,amim,seeds_id,network_id]), path(module), path(network), path(sp)]
     ch_proximity_input = ch_modules
@@ -2,7 +2,6 @@
 // Prepares the input for RWR and runs the tool
 //
 
-include { GRAPHTOOLPARSER   } from '../../../modules/local/graphtoolparser/main'
 include { RWR               } from '../../../modules/local/rwr/main'
 
 workflow GT_RWR {
@@ -12,18 +11,16 @@ workflow GT_RWR {
     scaling                                 // RWR specific parameter "scaling"
     symmetrical                             // RWR specific parameter "symmetrical"
     r                                       // RWR specific parameter "r"
+    batch                                   // Run all seed files of a network in one RWR task
 
     main:
 
     ch_versions = Channel.empty()                                           // For collecting tool versions
 
-    GRAPHTOOLPARSER(ch_network, "rwr")                                      // Convert gt file to rwr specific format
-    ch_versions = ch_versions.mix(GRAPHTOOLPARSER.out.versions)             // Collect versions
-
     // channel: [ val(meta[id,seeds_id,network_id), path(seeds), path(network) ]
     ch_rwr_input = ch_seeds
         .map{ meta, seeds -> [meta.network_id, meta, seeds]}
-        .combine(GRAPHTOOLPARSER.out.network.map{ meta, network -> [meta.network_id, meta, network]}, by: 0)
+        .combine(ch_network.map{ meta, network -> [meta.network_id, meta, network]}, by: 0)
         .map{network_id, seeds_meta, seeds, network_meta, network ->
             def meta = seeds_meta + network_meta
             meta.id = seeds_meta.seeds_id + "." + network_meta.id
@@ -31,10 +28,35 @@ workflow GT_RWR {
             [meta, seeds, network]
         }
 
-    RWR(ch_rwr_input, scaling, symmetrical, r)                              // Run RWR on parsed network
+    if (batch) {
+        // Solve all seed files of a network with one factorization (permuted networks are kept apart)
+        // channel: [ val(meta[id,network_key,batch]), [path(seeds)], path(network) ]
+        ch_rwr_batch_input = ch_rwr_input
+            .map{meta, seeds, network -> [meta.permuted_network_id ?: meta.network_id, seeds, network]}
+            .groupTuple()
+            .map{network_key, seeds, networks ->
+                [[id: network_key + ".rwr", network_key: network_key, batch: true], seeds, networks[0]]
+            }
+
+        RWR(ch_rwr_batch_input, scaling, symmetrical, r)                    // Run RWR on the gt network
+
+        // Assign the modules to their seeds, outputs are named <seeds>.connected_module_rwr_*.txt
+        // channel: [ val(meta[id,module_id,amim,seeds_id,network_id]), path(module) ]
+        ch_module = RWR.out.module
+            .flatMap{meta, modules ->
+                [modules].flatten().collect{module ->
+                    [meta.network_key, module.name.replaceFirst(/\.connected_module_rwr_.*$/, ''), module]
+                }
+            }
+            .combine(ch_rwr_input.map{meta, seeds, network -> [meta.permuted_network_id ?: meta.network_id, seeds.baseName, meta]}, by: [0,1])
+            .map{network_key, seeds_name, module, meta -> [meta, module]}
+    } else {
+        RWR(ch_rwr_input, scaling, symmetrical, r)                          // Run RWR on the gt network
+        ch_module = RWR.out.module
+    }
     ch_versions = ch_versions.mix(RWR.out.versions.first())
 
     emit:
-    module   = RWR.out.module  // channel: [ val(meta[id,module_id,amim,seeds_id,network_id]), path(module) ]
+    module   = ch_module       // channel: [ val(meta[id,module_id,amim,seeds_id,network_id]), path(module) ]
     versions = ch_versions              // channel: [ versions.yml ]        emit collected versions
 }
@@ -63,7 +63,7 @@ workflow NETWORKEXPANSION {
     }
 
     if(!params.skip_rwr){
-        GT_RWR(ch_seeds, ch_network, rwr_scaling, rwr_symmetrical, rwr_r)
+        GT_RWR(ch_seeds, ch_network, rwr_scaling, rwr_symmetrical, rwr_r, params.rwr_batch)
         ch_versions = ch_versions.mix(GT_RWR.out.versions)
         ch_raw_modules = ch_raw_modules.mix(GT_RWR.out.module)
     }
@@ -68,6 +68,16 @@ workflow PIPELINE_INITIALISATION {
         nextflow_cli_args
     )
 
+    //
+    // Create the cache directories, they are mounted into the containers
+    //
+    if (params.shortest_paths_cache) {
+        prepareCacheDirectory('shortest_paths_cache')
+    }
+    if (params.rwr_cache) {
+        prepareCacheDirectory('rwr_cache')
+    }
+
     ch_seeds = Channel.empty()          // channel: [ val(meta[id,seeds_id,network_id]), path(seeds) ]
     ch_network = Channel.empty()        // channel: [ val(meta[id,network_id]), path(network) ]
     ch_shortest_paths = Channel.empty() // channel: [ val(meta[id,network_id]), path(shortest_paths) ]
@@ -343,6 +353,21 @@ def mapPreparedNetwork(network, id_space) {
     }
 }
 
+//
+// Create a cache directory on the host, so that it can be bind-mounted into the containers
+// (see containerOptions in conf/modules.config). Only local directories can be mounted.
+//
+def prepareCacheDirectory(param_name) {
+    def cache = file(params[param_name])
+    if (workflow.containerEngine && !(workflow.containerEngine in ['docker', 'podman', 'singularity', 'apptainer'])) {
+        error("--${param_name} cannot be mounted into ${workflow.containerEngine} containers, use Docker, Podman, Singularity or Apptainer")
+    }
+    if (workflow.containerEngine && cache.scheme != 'file') {
+        error("--${param_name} must be a local directory when a container engine is used, it is mounted into the containers")
+    }
+    cache.mkdirs()
+}
+
 //
 // Validate channels from input samplesheet
 //
@@ -348,7 +348,7 @@ workflow MODULEDISCOVERY {
 
     // Drug prioritization - Proximity
     if(params.run_proximity){
-        GT_PROXIMITY(ch_network_gt, SAVEMODULES.out.nodes_tsv, ch_shortest_paths, proximity_dt)
+        GT_PROXIMITY(ch_network_gt, SAVEMODULES.out.nodes_tsv, ch_shortest_paths, proximity_dt, params.shortest_paths_targets_only, params.proximity_group_modules)
         ch_versions = ch_versions.mix(GT_PROXIMITY.out.versions)
     }
 